@@ -0,0 +1,115 @@
+import os
+import optparse
+import random
+import tempfile
+import time
+from pygtail import Pygtail
+from pretaweb.collectd.groupingtail.tailer import ChunkedTail
+from pretaweb.collectd.groupingtail.groupingtail import GroupingTail
+from pretaweb.collectd.groupingtail.instruments import CounterInc
+
+#
+# Small program to measure the throughput of the plugin parts on synthetic
+# swift proxy logs without running all collectd system
+#
+
+# Swift proxy log regex with the request method left as a parameter
+SWIFT_REGEX = ("^(?P<log_month>\\S+)\\s+(?P<log_day>\\S+)\\s+(?P<log_hour>\\S+)\\s+(?P<log_host>\\S+)\\s+"
+               "(?P<log_service>\\S+)\\s+(?P<client_ip>\\S+)\\s+(?P<remote_addr>\\S+)\\s+(?P<datetime>\\S+)\\s+"
+               "(?P<request_method>%s)\\s+\\/v1\\/AUTH_(?P<tenant>\\w+)(\\/\\S+|\\/|)\\s+(?P<protocol>\\S+)\\s+"
+               "(?P<status_int>\\S+)\\s+(?P<referer>\\S+)\\s+(?P<user_agent>\\S+)\\s+(?P<auth_token>\\S+)\\s+"
+               "(?P<bytes_recvd>\\S+)\\s+(?P<bytes_sent>\\S+)\\s+(?P<client_etag>\\S+)\\s+(?P<transaction_id>\\S+)\\s+"
+               "(?P<headers>\\S+)\\s+(?P<request_time>\\S+)\\s+(?P<source>\\S+)\\s+(?P<log_info>\\S+)\\s+"
+               "(?P<request_start_time>\\S+)\\s+(?P<request_end_time>\\S+)(\\s+(?P<policy_index>\\S+)){0,1}")
+
+METHODS = ["GET", "PUT", "HEAD", "POST", "DELETE", "COPY", "OPTIONS"]
+
+LINE = ("Dec  2 17:19:27 swift_mdw proxy-server: 10.30.235.235 10.30.235.235 02/Dec/2015/16/19/27 %s "
+        "/v1/AUTH_%s/container/object HTTP/1.0 200 - python-swiftclient-2.3.1 4a49577fae884452... %d %d - "
+        "tx3de6f87d0fa7499c9386d-00565f1a0f - 0.0449 - - 1449073167.457756042 1449073167.502661943 2")
+
+
+# Synthetic swift proxy log lines, with a share of unrelated syslog lines
+def swift_lines(count, tenants=16, noise=0.5):
+    rnd = random.Random(0)
+    lines = []
+    for i in xrange(count):
+        if rnd.random() < noise:
+            lines.append("Dec  2 17:19:27 swift_mdw kernel: [%d.000000] eth0: link up" % i)
+        else:
+            lines.append(LINE % (rnd.choice(METHODS[:3]), "tenant%d" % rnd.randrange(tenants),
+                                 rnd.randrange(10 ** 6), rnd.randrange(10 ** 6)))
+    return lines
+
+
+# Best lines per second processed by a GroupingTail over some runs
+def lines_per_second(grouping_tail, lines, runs=3):
+    best = None
+    for run in range(runs):
+        start = time.time()
+        for line in lines:
+            grouping_tail.process_line(line)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / best
+
+
+# Lines per second versus number of Match blocks for each match engine, with
+# Match regexes selecting a request method or matching every swift line
+def bench_matchers(lines, counts):
+    print "%8s %8s %12s %12s" % ("matches", "methods", "separate", "combined")
+    for count in counts:
+        for methods in (METHODS, ["\\S+"]):
+            rates = []
+            for engine in ("separate", "combined"):
+                grouping_tail = GroupingTail("/dev/null", SWIFT_REGEX % "\\S+", "tenant", match_engine=engine)
+                for i in range(count):
+                    regex = SWIFT_REGEX % methods[i % len(methods)]
+                    grouping_tail.add_match("match%d" % i, "counter", CounterInc(regex))
+                rates.append(lines_per_second(grouping_tail, lines))
+            print "%8d %8s %12d %12d" % (count, "any" if len(methods) == 1 else "each", rates[0], rates[1])
+
+
+# Megabytes per second and lines per second read by Pygtail and the chunked
+# tail from a log of size_mb megabytes
+def bench_tailers(size_mb):
+    log = tempfile.NamedTemporaryFile(delete=False)
+    block = "\n".join(swift_lines(10000)) + "\n"
+    while log.tell() < size_mb * 1024 * 1024:
+        log.write(block)
+    log.close()
+    size = os.path.getsize(log.name)
+
+    print "%8s %12s %12s" % ("tailer", "MB/s", "lines/s")
+    tailers = [
+        ("pygtail", lambda offset_file: Pygtail(log.name, offset_file=offset_file, copytruncate=True)),
+        ("chunked", lambda offset_file: ChunkedTail(log.name, offset_file=offset_file)),
+    ]
+    try:
+        for name, tailer in tailers:
+            offset_file = log.name + "." + name
+            start = time.time()
+            count = 0
+            for line in tailer(offset_file).readlines():
+                count += 1
+            elapsed = time.time() - start
+            os.remove(offset_file)
+            print "%8s %12.1f %12d" % (name, size / elapsed / 1024 / 1024, count / elapsed)
+    finally:
+        os.remove(log.name)
+
+
+def main():
+    p = optparse.OptionParser()
+    p.add_option('--lines', '-n', type="int", default=20000)
+    p.add_option('--tail-mb', type="int", default=16)
+    options, arguments = p.parse_args()
+
+    lines = swift_lines(options.lines)
+    bench_matchers(lines, [1, 2, 4, 8, 16])
+    bench_tailers(options.tail_mb)
+
+
+if __name__ == '__main__':
+    main()
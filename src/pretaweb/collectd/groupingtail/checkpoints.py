@@ -0,0 +1,99 @@
+import os
+import time
+import errno
+import hashlib
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Bytes before the end of file where reading starts without a checkpoint store
+END_BACKLOG = 1024
+# Bytes read looking for the start of the first complete line
+LINE_SEARCH_SIZE = 64 * 1024
+
+
+# Directory keeping the offset reached in each file across restarts. Offset files
+# are named after the file path and hold the inode and offset, with the format of
+# Pygtail, so a checkpoint is only used while the path names the same file.
+class CheckpointStore(object):
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        try:
+            os.makedirs(state_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    # Offset file of the file at filepath
+    def offset_file(self, filepath):
+        key = hashlib.sha1(os.path.realpath(filepath)).hexdigest()
+        return os.path.join(self.state_dir, "%s.offset" % key)
+
+
+# Checkpoint stored in offset_file as (inode, offset, age in seconds), or None
+def read_checkpoint(offset_file):
+    try:
+        with open(offset_file) as foffset:
+            inode, offset = foffset.read().split()[:2]
+        age = time.time() - os.stat(offset_file).st_mtime
+    except (IOError, OSError, ValueError):
+        return None
+    return int(inode), int(offset), age
+
+
+# Store checkpoint (inode, offset) in offset_file, replacing it atomically
+def write_checkpoint(offset_file, checkpoint):
+    temporal = offset_file + ".tmp"
+    with open(temporal, "w") as foffset:
+        foffset.write("%s\n%s" % checkpoint)
+    os.rename(temporal, offset_file)
+
+
+# Offset of the first line starting at or after offset in path
+def line_start(path, offset):
+    if offset <= 0:
+        return 0
+    with open(path, "rb") as fh:
+        fh.seek(offset - 1)
+        data = fh.read(LINE_SEARCH_SIZE)
+    end_of_line = data.find("\n")
+    if end_of_line == -1:
+        # No line end close enough, the first line read is partial
+        return offset
+    return offset + end_of_line
+
+
+# Checkpoint (inode, offset) where reading of the file at filepath starts, or
+# None if it does not exist. Start is either "end", for the end of the file less
+# backlog bytes, "resume", for the saved checkpoint, or "catchup", for the saved
+# checkpoint if it is at most max_seconds old and at most max_bytes behind.
+# Reading starts from the end when the saved checkpoint can not be used, and
+# from the beginning when the file was rotated since it was saved.
+def start_checkpoint(filepath, saved=None, start="end", max_bytes=None, max_seconds=None, backlog=0):
+    if start not in ("end", "resume", "catchup"):
+        raise ValueError("Unknown start position %r" % start)
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    size = stat.st_size
+    end = line_start(filepath, size - backlog)
+
+    if start == "end" or saved is None:
+        return stat.st_ino, end
+    inode, offset, age = saved
+    if inode != stat.st_ino:
+        # Rotated while stopped, the whole new file is unread
+        offset = 0
+    elif offset > size:
+        # Truncated while stopped
+        offset = 0
+    if start == "catchup":
+        if max_seconds is not None and age > max_seconds:
+            logger.info("Checkpoint of %s is %d seconds old, starting from the end", filepath, age)
+            return stat.st_ino, end
+        if max_bytes is not None and size - offset > max_bytes:
+            logger.info("%s is %d bytes behind, catching up the last %d", filepath, size - offset, max_bytes)
+            offset = line_start(filepath, size - max_bytes)
+    return stat.st_ino, offset
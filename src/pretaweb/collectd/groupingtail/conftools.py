@@ -1,6 +1,14 @@
+import os
+import re
 import logging
-from groupingtail import GroupingTail
-from instruments import NUM32, CounterInc, CounterSum, GaugeInt, DeriveCounter, GaugeThroughput, GaugeTotalThroughput
+import urlparse
+from groupingtail import GroupingTail, TailSource
+from predicates import parse_predicate
+from checkpoints import CheckpointStore
+from eventtime import EventTime
+from receiver import BUFFER_LINES, SPILL_MAX_BYTES
+from instruments import NUM32, CounterInc, CounterSum, GaugeInt, DeriveCounter, GaugeThroughput, GaugeTotalThroughput, \
+    Quantiles, DistinctCount, TopK, Summary, SUMMARY_STATISTICS, WindowRate, EwmaRate
 
 _getConfFirstValue_NOVAL = object()
 
@@ -17,6 +25,40 @@ def getConfFirstValue(ob, key, default=_getConfFirstValue_NOVAL):
     return default
 
 
+# Auxiliar conf method, boolean values either native or as text
+def getConfBool(ob, key, default=False):
+    value = getConfFirstValue(ob, key, default)
+    if isinstance(value, basestring):
+        return value.lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+# Auxiliar conf methods, numeric values or default when not given
+def getConfInt(ob, key, default=None):
+    value = getConfFirstValue(ob, key, None)
+    return int(value) if value is not None else default
+
+
+def getConfFloat(ob, key, default=None):
+    value = getConfFirstValue(ob, key, None)
+    return float(value) if value is not None else default
+
+
+# Auxiliar conf method, all the values of the first item key, either given as
+# separate values or as a single text separated by spaces
+def getConfValues(ob, key, default=()):
+    for o in ob.children:
+        if o.key.lower() == key.lower():
+            values = []
+            for value in o.values:
+                if isinstance(value, basestring):
+                    values.extend(value.split())
+                else:
+                    values.append(value)
+            return values
+    return list(default)
+
+
 # Auxiliar Tree method
 def getConfChildren(ob, key):
     children = []
@@ -26,65 +68,180 @@ def getConfChildren(ob, key):
     return children
 
 
+# Auxiliar conf method, predicates of a Match without regex
+def getConfPredicates(ob):
+    return [parse_predicate(o.values[0]) for o in getConfChildren(ob, "Where")]
+
+
+# Auxiliar conf method, literals required in lines
+def getConfRequire(ob):
+    return [o.values[0] for o in getConfChildren(ob, "Require")]
+
+
 #
 # Instruments library and generators
 #
 def configure_counterinc(conf):
-    # Regex to do the matching
-    regex = getConfFirstValue(conf, 'Regex')
-    return CounterInc(regex)
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, 'Regex', None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
+    return CounterInc(regex, predicates=predicates, require=require)
 
 
 def configure_countersumint(conf):
-    # Regex to do the matching
-    regex = getConfFirstValue(conf, "Regex")
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
     # Regex group name, or None that acts as first group in regex
     groupname = getConfFirstValue(conf, "GroupName", None)
     # Function to perform casting to data extracted from field groupname of regex
     value_cast = (lambda x: int(x) % NUM32)
-    return CounterSum(regex, value_cast=value_cast, groupname=groupname)
+    return CounterSum(regex, value_cast=value_cast, groupname=groupname, predicates=predicates, require=require)
 
 
 def configure_gaugeint(conf):
-    # Regex to do the matching
-    regex = getConfFirstValue(conf, "Regex")
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
     # Regex group name, or None that acts as first group in regex
     groupname = getConfFirstValue(conf, "GroupName", None)
     # Function to perform casting to data extracted from field groupname of regex
     value_cast = (lambda x: int(x) % NUM32)
-    return GaugeInt(regex, value_cast=value_cast, groupname=groupname)
+    return GaugeInt(regex, value_cast=value_cast, groupname=groupname, predicates=predicates, require=require)
 
 
 def configure_derivecounter(conf):
-    # Regex to do the matching
-    regex = getConfFirstValue(conf, "Regex")
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
     # Regex group name, or None that acts as first group in regex
     groupname = getConfFirstValue(conf, "GroupName", None)
     # Function to perform casting to data extracted from field groupname of regex
     value_cast = (lambda x: int(x) % NUM32)
-    return DeriveCounter(regex, value_cast=value_cast, groupname=groupname)
+    return DeriveCounter(regex, value_cast=value_cast, groupname=groupname, predicates=predicates, require=require)
 
 
 def configure_gaugethroughput(conf):
-    # Regex to do the matching
-    regex = getConfFirstValue(conf, "Regex")
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
     # Regex group name, or None that acts as first group in regex
     groupname = getConfFirstValue(conf, "GroupName", None)
     # Regex group name, or None that acts as first group in regex
     grouptime = getConfFirstValue(conf, "GroupTime", None)
-    return GaugeThroughput(regex, groupname=groupname, grouptime=grouptime)
+    return GaugeThroughput(regex, groupname=groupname, grouptime=grouptime, predicates=predicates, require=require)
 
 
 def configure_gaugetotalthroughput(conf):
-    # Regex to do the matching
-    regex = getConfFirstValue(conf, "Regex")
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
     # Regex group name for one of the matchings, or None that invalidates the metric
     groupone = getConfFirstValue(conf, "GroupOne", None)
     # Regex group name for other of the matchings, or None that invalidates the metric
     groupother = getConfFirstValue(conf, "GroupOther", None)
     # Regex group name for time value, or None that invalidates the metric
     grouptime = getConfFirstValue(conf, "GroupTime", None)
-    return GaugeTotalThroughput(regex, groupone=groupone, groupother=groupother, grouptime=grouptime)
+    return GaugeTotalThroughput(regex, groupone=groupone, groupother=groupother, grouptime=grouptime, predicates=predicates, require=require)
+
+
+def configure_quantiles(conf):
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
+    # Regex group name, or None that acts as first group in regex
+    groupname = getConfFirstValue(conf, "GroupName", None)
+    # Quantiles read, either as fractions or as percentiles
+    quantiles = [float(q) for q in getConfValues(conf, "Quantiles", (0.5, 0.95, 0.99))]
+    quantiles = [q / 100 if q > 1 else q for q in quantiles]
+    # Relative accuracy of the estimates, and most buckets kept per group
+    accuracy = getConfFloat(conf, "RelativeAccuracy", 0.01)
+    max_buckets = getConfInt(conf, "MaxBuckets", 2048)
+    return Quantiles(regex, groupname=groupname, quantiles=quantiles, accuracy=accuracy, max_buckets=max_buckets,
+                     predicates=predicates, require=require)
+
+
+def configure_distinctcount(conf):
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
+    # Regex group name, or None that acts as first group in regex
+    groupname = getConfFirstValue(conf, "GroupName", None)
+    # Counters of 2 ** precision bytes per group
+    precision = getConfInt(conf, "Precision", 12)
+    return DistinctCount(regex, groupname=groupname, precision=precision, predicates=predicates, require=require)
+
+
+def configure_topk(conf):
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
+    # Regex group name of the sub-key, or None that acts as first group in regex
+    groupname = getConfFirstValue(conf, "GroupName", None)
+    # Sub-keys read per group, and sub-keys tracked per group
+    top = getConfInt(conf, "Top", 10)
+    capacity = getConfInt(conf, "Capacity", None)
+    return TopK(regex, groupname=groupname, top=top, capacity=capacity, predicates=predicates, require=require)
+
+
+def configure_summary(conf):
+    # Regex to do the matching, or None to use the record fields
+    regex = getConfFirstValue(conf, "Regex", None)
+    # Conditions over the record fields
+    predicates = getConfPredicates(conf)
+    # Literals required in matching lines
+    require = getConfRequire(conf)
+    # Regex group name, or None that acts as first group in regex
+    groupname = getConfFirstValue(conf, "GroupName", None)
+    # Statistics read, in the order of the data sources of the collectd type
+    statistics = [statistic.lower() for statistic in getConfValues(conf, "Statistics", SUMMARY_STATISTICS)]
+    return Summary(regex, groupname=groupname, statistics=statistics, predicates=predicates, require=require)
+
+
+def configure_smoothedrate(rate_class):
+    def configure(conf):
+        # Regex to do the matching, or None to use the record fields
+        regex = getConfFirstValue(conf, "Regex", None)
+        # Conditions over the record fields
+        predicates = getConfPredicates(conf)
+        # Literals required in matching lines
+        require = getConfRequire(conf)
+        # Regex group name, or None that acts as first group in regex
+        groupname = getConfFirstValue(conf, "GroupName", None)
+        # Without a value to add up, lines are counted
+        count_lines = groupname is None and (regex is None or re.compile(regex).groups == 0)
+        # Windows in seconds
+        windows = [float(seconds) for seconds in getConfValues(conf, "Windows", (60, 300, 900))]
+        return rate_class(regex, groupname=groupname, windows=windows, count_lines=count_lines,
+                          predicates=predicates, require=require)
+    return configure
 
 
 # Dict with configurations of each instrument available
@@ -94,12 +251,44 @@ INSTRUMENTS = {
     "GaugeInt": configure_gaugeint,
     "GaugeThroughput": configure_gaugethroughput,
     "GaugeTotalThroughput": configure_gaugetotalthroughput,
-    "DeriveCounter": configure_derivecounter
+    "DeriveCounter": configure_derivecounter,
+    "Quantiles": configure_quantiles,
+    "DistinctCount": configure_distinctcount,
+    "TopK": configure_topk,
+    "Summary": configure_summary,
+    "WindowRate": configure_smoothedrate(WindowRate),
+    "EwmaRate": configure_smoothedrate(EwmaRate)
 }
 
 
+# Key identifying a source, so that the same file or url is only read once
+def source_key(filepath):
+    if urlparse.urlparse(filepath).scheme:
+        return filepath
+    return os.path.realpath(filepath)
+
+
+# Distinct sources of all configured files, in configuration order
+def get_sources(files):
+    sources = []
+    for f in files:
+        source = f["grouping_tail"].source
+        if source not in sources:
+            sources.append(source)
+    return sources
+
+
 def read_config(conf):
     files = []
+    # Sources already opened, by source key
+    sources = {}
+    # Directory keeping the offset reached in each file across restarts, or
+    # None to start near the end of the files at each start
+    state_dir = getConfFirstValue(conf, 'StateDir', None)
+    checkpoints = CheckpointStore(state_dir) if state_dir is not None else None
+    # Syslog sockets are served by their own threads, unless an event loop
+    # serves all of them
+    receive_thread = getConfFirstValue(conf, 'IngestionEngine', "threads").lower() != "loop"
     # Read all <file>*</file> blocks in config file
     for f in getConfChildren(conf, "File"):
         instance_name = getConfFirstValue(f, 'Instance')
@@ -109,11 +298,60 @@ def read_config(conf):
         groupby = getConfFirstValue(f, 'GroupBy')
         # Regex group name, or None that acts as first group in regex
         groupbygroup = getConfFirstValue(f, 'GroupName', None)
+        # Regex extracting the fields for Match blocks without regex, or None
+        # to use the fields of the GroupBy regex
+        record = getConfFirstValue(f, 'Record', None)
+        # Literals required in grouped lines
+        require = getConfRequire(f)
+        # How Match regexes are run, one by one or combined in a single regex
+        match_engine = getConfFirstValue(f, 'MatchEngine', "separate").lower()
         # Maximum number of groups
         maxgroups = int(getConfFirstValue(f, 'MaxGroups', 64))
+        # Group adding up the values of the groups left out, or None
+        othergroup = getConfFirstValue(f, 'OtherGroup', None)
+        # Groups kept by activity in each Match, or by recency for the File
+        retention = getConfFirstValue(f, 'GroupRetention', "active").lower()
+        # Field with the timestamp of each line, to measure lines in event time,
+        # or None to measure them in the read cycle they are processed
+        event_field = getConfFirstValue(f, 'EventTimeField', None)
+        event_time = None
+        if event_field is not None:
+            event_time = EventTime(event_field,
+                                   timestamp_format=getConfFirstValue(f, 'EventTimeFormat', "epoch"),
+                                   bucket_seconds=getConfFloat(f, 'EventTimeBucket', 10.0),
+                                   watermark=getConfFloat(f, 'EventTimeWatermark', 60.0))
+
+        # Files with the same path or url share a single reader
+        key = source_key(filepath)
+        if key not in sources:
+            # Either "chunked" or "pygtail", given by the first File of the source
+            tailer = getConfFirstValue(f, 'Tailer', "chunked").lower()
+            # Where reading starts with a state directory: "resume", "end" or
+            # "catchup", bounded by CatchUpBytes and CatchUpSeconds
+            start = getConfFirstValue(f, 'StartPosition', "resume").lower()
+            # Socket buffer bytes and buffered lines of syslog urls
+            rcvbuf = getConfInt(f, 'ReceiveBuffer')
+            buffer_lines = getConfInt(f, 'BufferLines', BUFFER_LINES)
+            # Directory where lines over BufferLines are spilled, and the most
+            # bytes spilled, for syslog urls
+            spill_dir = getConfFirstValue(f, 'SpillDir', None)
+            spill_max_bytes = getConfInt(f, 'SpillMaxBytes', SPILL_MAX_BYTES)
+            # Sockets bound to the port of syslog urls
+            receive_sockets = getConfInt(f, 'ReceiveSockets', 1)
+            sources[key] = TailSource(filepath, tailer=tailer, checkpoints=checkpoints, start=start,
+                                      max_bytes=getConfInt(f, 'CatchUpBytes'),
+                                      max_seconds=getConfFloat(f, 'CatchUpSeconds'),
+                                      rcvbuf=rcvbuf, buffer_lines=buffer_lines,
+                                      receive_sockets=receive_sockets, receive_thread=receive_thread,
+                                      spill_dir=spill_dir, spill_max_bytes=spill_max_bytes)
+        # Parser processes sharing out the lines of the source
+        shards = int(getConfFirstValue(f, 'Shards', 0))
+        sources[key].shard_count = max(sources[key].shard_count, shards)
 
         # Create GroupingTail for this configuration
-        gt = GroupingTail(filepath, groupby, groupbygroup)
+        gt = GroupingTail(filepath, groupby, groupbygroup, source=sources[key], record=record,
+                          require=require, match_engine=match_engine, retention=retention, maxgroups=maxgroups,
+                          event_time=event_time)
 
         # List with files to check
         files.append(dict(
@@ -133,7 +371,22 @@ def read_config(conf):
 
             # read and create instrument
             instrument = INSTRUMENTS[dstype](m)
+            # Buckets are read one after another, each instrument starting empty
+            if event_time is not None and not instrument.per_read:
+                raise ValueError("DSType %s of %s keeps values across reads and can not be used with "
+                                 "EventTimeField" % (dstype, filepath))
+            # Groups kept, given by the File unless the Match sets them
+            instrument.set_groups_limit(getConfInt(m, 'MaxGroups', maxgroups),
+                                        getConfFirstValue(m, 'OtherGroup', othergroup))
 
             # Add matching to groupingtail
             gt.add_match(minstance_name, valuetype, instrument)
+
+    # Shards and receiver processes collect into the bucket being filled. Any
+    # File of a source may add shards, so sources are checked once all read
+    for f in files:
+        source = f["grouping_tail"].source
+        if f["grouping_tail"].event_time is not None and (
+                source.shard_count > 0 or getattr(source, 'receiver_args', (0,))[0] > 0):
+            raise ValueError("EventTimeField of %s can not be used with Shards or ReceiveSockets" % source.filepath)
     return files
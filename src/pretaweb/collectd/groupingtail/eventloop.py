@@ -0,0 +1,93 @@
+import time
+import errno
+import select
+import threading
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+
+# Single thread serving every source: the sockets of the syslog sources and the
+# change notifier of the file sources are multiplexed with select, and a source
+# is only processed once something arrived for it. File sources without change
+# notification are checked every poll_interval seconds. Processing is limited
+# to budget seconds per source and pass, and sockets are drained between
+# sources, so a busy source neither starves the others nor leaves datagrams to
+# be dropped. The syslog receiver threads of the sources must not be started.
+class EventLoop(threading.Thread):
+    def __init__(self, sources, budget=0.5, poll_interval=0.5, notifier=None):
+        super(EventLoop, self).__init__(name="groupingtail-loop")
+        self.setDaemon(True)
+        self.sources = list(sources)
+        self.budget = budget
+        self.poll_interval = poll_interval
+        self.notifier = notifier
+        # Syslog receivers and their sources
+        self.receivers = [(source.server, source) for source in self.sources if hasattr(source, 'server')]
+        # File sources only checked every poll interval
+        self.polled = [source for source in self.sources
+                       if not hasattr(source, 'server') and not source.watched]
+        self.stopped = threading.Event()
+
+    # Wait up to timeout seconds for sockets or the notifier, receiving what
+    # arrived. Returns the sources with something new.
+    def wait(self, timeout):
+        handlers = {}
+        for receiver, source in self.receivers:
+            for fd in receiver.filenos():
+                handlers[fd] = (receiver, source)
+        fds = list(handlers)
+        notifier_fd = None
+        if self.notifier is not None and hasattr(self.notifier, "fileno"):
+            notifier_fd = self.notifier.fileno()
+            fds.append(notifier_fd)
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        changed = set()
+        for fd in readable:
+            if fd == notifier_fd:
+                changed |= self.notifier.poll()
+            else:
+                receiver, source = handlers[fd]
+                receiver.receive(fd)
+                changed.add(source)
+        return changed
+
+    # Sources to check because a poll interval went by
+    def poll(self):
+        changed = set(self.polled)
+        if self.notifier is not None and not hasattr(self.notifier, "fileno"):
+            changed |= self.notifier.poll()
+        return changed
+
+    def run(self):
+        # Sources to process in the next pass, at first all of them
+        ready = set(self.sources)
+        next_poll = time.time() + self.poll_interval
+        while not self.stopped.is_set():
+            # Sources with lines left when their budget ran out, or with
+            # something new received meanwhile
+            pending = set()
+            for source in self.sources:
+                if source not in ready:
+                    continue
+                try:
+                    if not source.update(self.budget):
+                        pending.add(source)
+                except Exception:
+                    # A failing source must not stop ingestion of the others
+                    logger.exception("Error updating %s", source.filepath)
+                pending |= self.wait(0)
+            timeout = 0 if pending else max(next_poll - time.time(), 0)
+            ready = pending | self.wait(timeout)
+            if time.time() >= next_poll:
+                ready |= self.poll()
+                next_poll = time.time() + self.poll_interval
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,116 @@
+import time
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Month numbers of the syslog (RFC 3164) timestamps
+MONTHS = dict((name, number) for number, name in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1))
+
+
+# Parser of the timestamps of a log into seconds since the epoch. Format is
+# either "epoch", seconds since the epoch, "syslog", the local time of a syslog
+# header such as "Oct 18 12:34:56", or a time.strptime format in local time.
+# Consecutive lines mostly share their timestamp, so the last one parsed is
+# cached. Returns None for timestamps that can not be parsed.
+class TimestampParser(object):
+    def __init__(self, timestamp_format="epoch"):
+        self.timestamp_format = timestamp_format
+        self.last_text = None
+        self.last_time = None
+
+    def __call__(self, text):
+        if text is None:
+            return None
+        if text == self.last_text:
+            return self.last_time
+        try:
+            if self.timestamp_format == "epoch":
+                seconds = float(text)
+            elif self.timestamp_format == "syslog":
+                seconds = self.parse_syslog(text)
+            else:
+                seconds = time.mktime(time.strptime(text, self.timestamp_format))
+        except (ValueError, KeyError, OverflowError):
+            return None
+        self.last_text = text
+        self.last_time = seconds
+        return seconds
+
+    # Syslog timestamps have no year, the one putting them closest to now is used
+    @staticmethod
+    def parse_syslog(text):
+        month, day, clock = text.split()
+        hour, minute, second = clock.split(":")
+        now = time.localtime()
+        fields = [now.tm_year, MONTHS[month], int(day), int(hour), int(minute), int(second), 0, 0, -1]
+        seconds = time.mktime(fields)
+        # Sent at the end of last year, or clocks slightly ahead at new year
+        if seconds - time.time() > 180 * 86400:
+            fields[0] -= 1
+            seconds = time.mktime(fields)
+        elif time.time() - seconds > 180 * 86400:
+            fields[0] += 1
+            seconds = time.mktime(fields)
+        return seconds
+
+
+# Assignment of lines to buckets of bucket_seconds by their own timestamp, read
+# from field. Buckets are closed, and read, once the latest timestamp seen is
+# watermark seconds past their end, so lines arriving up to watermark seconds
+# late are still added to their bucket. Later lines, lines without a valid
+# timestamp and lines over watermark seconds ahead of the clock are counted and
+# left out.
+class EventTime(object):
+    def __init__(self, field, timestamp_format="epoch", bucket_seconds=10, watermark=60):
+        self.field = field
+        self.parse = TimestampParser(timestamp_format)
+        self.bucket_seconds = bucket_seconds
+        self.watermark = watermark
+        # Latest timestamp seen, and start of the first bucket still open
+        self.max_time = None
+        self.closed = None
+        # Lines left out for being too late or without timestamp
+        self.late = 0
+        self.untimed = 0
+        # Lines bucketed since the last close, and time of the last close
+        self.lines = 0
+        self.last_close = time.time()
+
+    # Start of the bucket of a line with timestamp text, or None if left out
+    def bucket(self, text):
+        seconds = self.parse(text)
+        if seconds is None:
+            self.untimed += 1
+            return None
+        start = seconds - seconds % self.bucket_seconds
+        if self.closed is not None and start < self.closed:
+            self.late += 1
+            return None
+        if self.max_time is None or seconds > self.max_time:
+            # Timestamps ahead of the clock, such as milliseconds, would close
+            # every bucket up to them
+            if seconds > time.time() + self.watermark:
+                self.untimed += 1
+                return None
+            self.max_time = seconds
+        self.lines += 1
+        return start
+
+    # Close the buckets past the watermark. Without lines since the last close,
+    # time is taken to go by as on the clock, so that the buckets of a quiet
+    # log are closed too. Returns the start of the first bucket still open, or
+    # None before any timestamp is seen.
+    def close(self, now):
+        if self.max_time is None:
+            return None
+        if self.lines == 0:
+            self.max_time += max(now - self.last_close, 0)
+        self.lines = 0
+        self.last_close = now
+        boundary = self.max_time - self.watermark
+        closed = boundary - boundary % self.bucket_seconds
+        if self.closed is None or closed > self.closed:
+            self.closed = closed
+        return self.closed
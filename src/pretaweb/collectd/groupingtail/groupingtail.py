@@ -1,97 +1,351 @@
 import os
+import time
+import itertools
 import threading
-import uuid
-import re
+import weakref
+import tempfile
+import hashlib
 from pygtail import Pygtail
 import urlparse
-import SocketServer
-import Queue
 import logging
 import logging.handlers
+from prefilter import build_prefilter
+from multimatch import CombinedMatcher, can_combine
+from patterns import get_pattern
+from workers import ShardPool, ReceiverPool
+from tailer import ChunkedTail
+from receiver import QueueFile, SpillSegment, SyslogReceiver, TcpSyslogReceiver, BUFFER_LINES, SPILL_MAX_BYTES
+from recency import RecentGroups
+from checkpoints import END_BACKLOG, read_checkpoint, write_checkpoint, start_checkpoint
 
 logger = logging.getLogger("GROUPINGTAIL")
 
+# Lines processed while holding the source lock
+BATCH_LINES = 512
 
-# Syslog handler
-class SyslogUDPHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
-        data = bytes.decode(self.request[0].strip().strip('\x00'))
-        print data
-        self.server.queue.queue.put(str(data))
 
+# Fields extracted once from a line, quacking like a regex match object for
+# the instruments working without their own regex
+class Record(object):
+    def __init__(self, mo):
+        self.fields = mo.groupdict()
+        self.values = mo.groups()
 
-# Queue file for syslog handler
-class QueueFile:
-    def __init__(self):
-        self.queue = Queue.Queue()
+    def groupdict(self):
+        return self.fields
 
-    def readlines(self):
-        while not self.queue.empty():
-            yield self.queue.get()
+    def groups(self):
+        return self.values
 
 
-# GroupingTail class that represents all matchings for a single file
-class GroupingTail(object):
-    def __init__(self, filepath, groupby, groupname=None):
-        self.groupmatch = re.compile(groupby)
-        # write an offset file so that we start somewhat at the end of the file
+# Source of log lines, shared by all GroupingTails reading the same file or url.
+# With a checkpoint store, the offset reached in a file is kept across restarts
+# and reading starts according to the start policy, see start_checkpoint.
+# Otherwise reading starts near the end of the file. Syslog urls are received
+# into a buffer of buffer_lines lines, with a socket buffer of rcvbuf bytes, on
+# receive_sockets sockets, all but one in their own processes. Without
+# receive_thread, the socket in this process is left to an event loop. With a
+# spill_dir, lines over buffer_lines are spilled there, up to spill_max_bytes.
+class TailSource(object):
+    def __init__(self, filepath, tailer="chunked", checkpoints=None, start="resume", max_bytes=None,
+                 max_seconds=None, rcvbuf=None, buffer_lines=BUFFER_LINES, receive_sockets=1,
+                 receive_thread=True, spill_dir=None, spill_max_bytes=SPILL_MAX_BYTES):
+        self.filepath = filepath
+        # Weak references to the GroupingTails fed with every line read from
+        # this source, so that they do not keep each other alive
+        self.tail_refs = []
+        # Held while lines are processed and while metrics are read, so that
+        # instruments are never read half updated
+        self.lock = threading.Lock()
+        # Lines read but not processed yet when a time budget ran out
+        self.pending = None
+        # Number of parser processes sharing out the lines, 0 to process them here
+        self.shard_count = 0
+        # Parser processes, once started
+        self.shards = None
+        # Processes receiving a syslog url on sockets of their own, once started
+        self.receivers = None
+        # True once a notifier reports changes of the file, so that it is only
+        # read when changed
+        self.watched = False
+        # Time since lines have been left unprocessed by a limited update, or
+        # None when caught up
+        self.behind_since = None
+        # While behind, only one line in sample is processed, 1 to process all
+        self.sample = 1
+        # Lines skipped by sampling
+        self.sampled_out = 0
+        # Add the lag of the source to the metrics of its GroupingTails
+        self.report_lag = False
 
         # either filepath is a path or a syslogd url
         (scheme, netloc, path, params, query, fragment) = urlparse.urlparse(filepath)
-        if scheme == 'syslog':
+        if scheme in ('syslog', 'syslog+tcp'):
             host, port = netloc.split(':')
-            self.fin = QueueFile()
-            self.server = SocketServer.UDPServer((host, int(port)), SyslogUDPHandler)
-            self.server.queue = self.fin
-
-            th = threading.Thread(target=lambda: self.server.serve_forever(poll_interval=0.5))
-            th.setDaemon(True)
-            th.start()
+            # Segment file taking the lines over buffer_lines, if any
+            spill = None
+            if spill_dir is not None:
+                spill_path = os.path.join(spill_dir, "%s.spill" % hashlib.sha1(filepath).hexdigest())
+                spill = SpillSegment(spill_path, spill_max_bytes)
+            self.fin = QueueFile(buffer_lines, spill)
+            if scheme == 'syslog':
+                self.server = SyslogReceiver(host, int(port), self.fin, rcvbuf=rcvbuf,
+                                             reuseport=receive_sockets > 1)
+                # Arguments of the receiver processes, started by start_shards
+                self.receiver_args = (receive_sockets - 1, host, int(port), rcvbuf, buffer_lines)
+            else:
+                self.server = TcpSyslogReceiver(host, int(port), self.fin, rcvbuf=rcvbuf)
+                # Connections are not shared out to receiver processes
+                self.receiver_args = (0,)
+            if receive_thread:
+                self.server.start()
         else:
-            # Create a temporal file with offset info
-            self.offsetpath = "/tmp/" + str(uuid.uuid4())
+            # Offset file kept by the tailer, and whether it is temporary
+            self.offsetpath = None
+            self.offset_temporary = False
+            if checkpoints is not None:
+                self.offsetpath = checkpoints.offset_file(filepath)
+                checkpoint = start_checkpoint(filepath, read_checkpoint(self.offsetpath), start,
+                                              max_bytes, max_seconds)
+            else:
+                checkpoint = start_checkpoint(filepath, backlog=END_BACKLOG)
+                if tailer == "pygtail":
+                    # Pygtail can only be told where to start with an offset file
+                    fd, self.offsetpath = tempfile.mkstemp(prefix="groupingtail-", suffix=".offset")
+                    os.close(fd)
+                    os.remove(self.offsetpath)
+                    self.offset_temporary = True
+            if checkpoint is not None and self.offsetpath is not None:
+                write_checkpoint(self.offsetpath, checkpoint)
+
+            # Either the chunked tail of this package or Pygtail
+            if tailer == "chunked":
+                self.fin = ChunkedTail(filepath, offset_file=self.offsetpath, checkpoint=checkpoint)
+            elif tailer == "pygtail":
+                self.fin = Pygtail(filepath, offset_file=self.offsetpath, copytruncate=True)
+            else:
+                raise ValueError("Unknown tailer %r" % tailer)
+
+    def __del__(self):
+        if hasattr(self, 'server'):
+            self.server.shutdown()
+            self.fin.close()
+        if getattr(self, 'offset_temporary', False):
             try:
-                inode = os.stat(filepath).st_ino
-                offset = os.path.getsize(filepath) - 1024
+                os.remove(self.offsetpath)
             except OSError:
                 pass
-            else:
-                if offset > 0:
-                    foffset = open(self.offsetpath, "w")
-                    foffset.write("%s\n%s" % (inode, offset))
-                    foffset.close()
+        self.stop_shards()
+
+    # Have changes of the file reported by notifier. Syslog sources are not
+    # files and are always read.
+    def watch(self, notifier):
+        if not hasattr(self, 'server'):
+            notifier.watch(self)
+            self.watched = True
+
+    # Start the parser processes sharing out the lines, and the receiver
+    # processes of a syslog url, if any
+    def start_shards(self):
+        if self.shard_count > 0 and self.shards is None:
+            self.shards = ShardPool(self, self.shard_count)
+            self.shards.start()
+        if hasattr(self, 'server') and self.receiver_args[0] > 0 and self.receivers is None:
+            self.receivers = ReceiverPool(self, *self.receiver_args)
+            self.receivers.start()
+
+    def stop_shards(self):
+        for pool in (self.shards, self.receivers):
+            if pool is not None:
+                pool.stop()
+        self.shards = self.receivers = None
+
+    # Attach a GroupingTail to be fed by this source
+    def add_grouping_tail(self, grouping_tail):
+        self.tail_refs.append(weakref.ref(grouping_tail))
 
-            self.fin = Pygtail(filepath, offset_file=self.offsetpath, copytruncate=True)
+    # GroupingTails still alive fed by this source
+    @property
+    def grouping_tails(self):
+        return [gt for gt in (ref() for ref in self.tail_refs) if gt is not None]
+
+    # Read last lines once and fan them out to every GroupingTail. Lines are
+    # read in batches and processed holding the lock, so readers wait at most
+    # one batch. Processing stops once budget seconds, max_lines lines or
+    # max_bytes bytes are over, checked between batches, and carries on from
+    # the same line in the next update. Returns True when all lines read have
+    # been processed.
+    def update(self, budget=None, max_lines=None, max_bytes=None):
+        if self.pending is None:
+            self.pending = iter(self.fin.readlines())
+        deadline = time.time() + budget if budget is not None else None
+        grouping_tails = self.grouping_tails
+        pending = self.pending
+        sample = self.sample if self.behind_since is not None else 1
+        # Lines and bytes read in this update
+        lines = 0
+        size = 0
+        while True:
+            batch = list(itertools.islice(pending, BATCH_LINES))
+            count = len(batch)
+            lines += count
+            if max_bytes is not None:
+                size += sum(len(line) + 1 for line in batch)
+            if sample > 1:
+                # Catching up: trade exact values for speed
+                batch = batch[::sample]
+                self.sampled_out += count - len(batch)
+            with self.lock:
+                if self.shards is not None:
+                    # Parsing is done by the shards
+                    if batch:
+                        self.shards.send(batch)
+                else:
+                    for line in batch:
+                        for grouping_tail in grouping_tails:
+                            grouping_tail.process_line(line)
+            if count < BATCH_LINES:
+                self.pending = None
+                self.behind_since = None
+                return True
+            if ((deadline is not None and time.time() >= deadline) or
+                    (max_lines is not None and lines >= max_lines) or
+                    (max_bytes is not None and size >= max_bytes)):
+                if self.behind_since is None:
+                    self.behind_since = time.time()
+                return False
+
+    # Bytes left to read, if known, and seconds since the source fell behind
+    def lag(self):
+        lag_bytes = self.fin.lag() if hasattr(self.fin, "lag") else None
+        lag_seconds = time.time() - self.behind_since if self.behind_since is not None else 0.0
+        return lag_bytes, lag_seconds
+
+
+# GroupingTail class that represents all matchings for a single file
+class GroupingTail(object):
+    def __init__(self, filepath, groupby, groupname=None, source=None, record=None, require=None,
+                 match_engine="separate", retention="active", maxgroups=64, event_time=None):
+        self.groupmatch = get_pattern(groupby)
+        # Check of literals required by the GroupBy regex, or None
+        self.prefilter = build_prefilter(groupby, require)
+        # Regex extracting the fields used by instruments without regex, by
+        # default the fields of the GroupBy regex
+        self.recordmatch = get_pattern(record) if record is not None else None
+
+        # Without a shared source, this GroupingTail reads the file on its own
+        if source is None:
+            source = TailSource(filepath)
+        self.source = source
+        self.source.add_grouping_tail(self)
 
         # List of matchings
         self.match_definitions = []
         # Regex group name for grouping
         self.groupbygroup = groupname
 
-    def __del__(self):
-        if hasattr(self, 'server'):
-            self.server.socket.close()
+        # Either "separate", running each instrument regex on its own, or
+        # "combined", running all of them in a single regex match
+        if match_engine not in ("separate", "combined"):
+            raise ValueError("Unknown match engine %r" % match_engine)
+        self.match_engine = match_engine
+        # Either "active", each instrument keeping its most active groups, or
+        # "recent", the maxgroups groups last seen kept for all instruments
+        if retention not in ("active", "recent"):
+            raise ValueError("Unknown group retention %r" % retention)
+        self.recency = RecentGroups(maxgroups) if retention == "recent" else None
+        # Instruments run through the combined regex, or None
+        self.combined = None
+        # Instruments checked one by one for every line
+        self.line_instruments = []
+        # EventTime assigning lines to buckets by their own timestamp, or None
+        # to measure lines in the read cycle they are processed
+        self.event_time = event_time
+        # State of the instruments in each open bucket but the current one, by
+        # bucket start, and start of the bucket the instruments are filling
+        self.buckets = {}
+        self.current_bucket = None
+
+    # File object the lines are read from
+    @property
+    def fin(self):
+        return self.source.fin
 
-    # Update method processing last lines
+    # Syslog server of the source, only for syslog urls
+    @property
+    def server(self):
+        return self.source.server
+
+    # Update method processing last lines. With a shared source, every
+    # GroupingTail attached to it is updated as well
     def update(self):
-        for line in self.fin.readlines():
-            groupname = None
-            mo = self.groupmatch.match(line)
-            if mo is not None:
-                if self.groupbygroup is None and mo.groups():
-                    # No groupbygroup get first group name
-                    groupname = mo.groups()[0]
-                elif self.groupbygroup is not None:
-                    # Get groupname from line
-                    groupname = mo.groupdict().get(self.groupbygroup)
-
-            if groupname is not None:
-                # Normalize groupname
-                groupname = groupname.replace(".", "_").replace("-", "_")
-                # Check all possible matchings
-                for match in self.match_definitions:
-                    instrument = match["instrument"]
+        self.source.update()
+
+    # Process a single line read from the source
+    def process_line(self, line):
+        # Discard lines missing a required literal without running the regex
+        if self.prefilter is not None and not self.prefilter(line):
+            return
+        groupname = None
+        mo = self.groupmatch.match(line)
+        if mo is not None:
+            if self.groupbygroup is None and mo.groups():
+                # No groupbygroup get first group name
+                groupname = mo.groups()[0]
+            elif self.groupbygroup is not None:
+                # Get groupname from line
+                groupname = mo.groupdict().get(self.groupbygroup)
+
+        if groupname is not None:
+            # Fields of the line, extracted at most once
+            record = None
+            if self.event_time is not None:
+                record = self.read_record(line, mo)
+                bucket = self.event_time.bucket(record.groupdict().get(self.event_time.field) if record else None)
+                if bucket is None:
+                    return
+                self.switch_bucket(bucket)
+            # Normalize groupname
+            groupname = groupname.replace(".", "_").replace("-", "_")
+            # Once per line for all the instruments
+            if self.recency is not None:
+                self.recency.touch(groupname)
+            # Check all matchings of the combined regex at once
+            if self.combined is not None:
+                self.combined.write(groupname, line)
+            # Check all possible matchings
+            for instrument in self.line_instruments:
+                if instrument.test is not None:
                     instrument.write(groupname, line)
+                    continue
+                if record is None:
+                    record = self.read_record(line, mo)
+                if record is not False:
+                    instrument.write_fields(groupname, line, record)
+
+    # Extract the fields of a line, or False if the record regex does not match
+    def read_record(self, line, mo):
+        if self.recordmatch is not None:
+            mo = self.recordmatch.match(line)
+            if mo is None:
+                return False
+        return Record(mo)
+
+    # Park the state of the instruments in the current bucket and bring in the
+    # one of bucket, empty if new
+    def switch_bucket(self, bucket):
+        if bucket == self.current_bucket:
+            return
+        instruments = [match["instrument"] for match in self.match_definitions]
+        if self.current_bucket is not None:
+            self.buckets[self.current_bucket] = [(instrument.data, instrument.groups) for instrument in instruments]
+        state = self.buckets.pop(bucket, None)
+        for number, instrument in enumerate(instruments):
+            if state is None:
+                instrument.reset()
+            else:
+                instrument.data, instrument.groups = state[number]
+        self.current_bucket = bucket
 
     # Attatch match to groupingtail class
     def add_match(self, instance_name, valuetype, instrument):
@@ -100,9 +354,73 @@ class GroupingTail(object):
             valuetype=valuetype,
             instrument=instrument
         ))
+        instrument.recency = self.recency
+        self.prepare_matching()
+
+    # Split instruments between the combined regex and line by line checks
+    def prepare_matching(self):
+        instruments = [match["instrument"] for match in self.match_definitions]
+        combined = []
+        if self.match_engine == "combined":
+            combined = [instrument for instrument in instruments if can_combine(instrument)]
+        # Combining a single regex would only add overhead
+        if len(combined) < 2:
+            combined = []
+        self.combined = CombinedMatcher(combined) if combined else None
+        self.line_instruments = [instrument for instrument in instruments if instrument not in combined]
+
+    # Number of lines discarded by each prefilter, GroupBy first
+    def prefilter_stats(self):
+        if self.prefilter is not None:
+            yield ("GroupBy", self.prefilter.rejected)
+        for match in self.match_definitions:
+            prefilter = match["instrument"].prefilter
+            if prefilter is not None:
+                yield (match["instance_name"], prefilter.rejected)
 
     # Get stored values from instrument
     def read_metrics(self):
+        # Bring in what the parser shards and receiver processes collected
+        for pool in (self.source.shards, self.source.receivers):
+            if pool is not None:
+                pool.collect()
+        # Groups not seen lately are dropped from every instrument
+        if self.recency is not None:
+            evicted = self.recency.trim()
+            for match in self.match_definitions:
+                for groupname in evicted:
+                    match["instrument"].evict(groupname)
+        if self.event_time is None:
+            for metric in self.read_instruments():
+                yield metric
+        else:
+            for metric in self.read_buckets():
+                yield metric
+
+        if self.source.report_lag:
+            lag_bytes, lag_seconds = self.source.lag()
+            if lag_bytes is not None:
+                yield ("lag_bytes", "bytes", lag_bytes)
+            yield ("lag_seconds", "delay", lag_seconds)
+            yield ("sampled_out", "counter", self.source.sampled_out)
+            # Lines discarded by each prefilter without running its regex
+            for name, rejected in self.prefilter_stats():
+                yield ("prefiltered_%s" % name, "counter", rejected)
+            if self.event_time is not None:
+                yield ("late_lines", "counter", self.event_time.late)
+                yield ("untimed_lines", "counter", self.event_time.untimed)
+            if hasattr(self.source, 'server'):
+                received, dropped, kernel_dropped = self.source.server.stats()
+                yield ("buffered", "gauge", len(self.source.fin))
+                if self.source.fin.spill is not None:
+                    yield ("spill_bytes", "bytes", self.source.fin.spill.pending_bytes())
+                yield ("received", "counter", received)
+                yield ("dropped", "counter", dropped)
+                if kernel_dropped is not None:
+                    yield ("kernel_dropped", "counter", kernel_dropped)
+
+    # Metrics of every instrument
+    def read_instruments(self):
         # For all matchings
         for match in self.match_definitions:
             instance_name = match["instance_name"]
@@ -113,5 +431,30 @@ class GroupingTail(object):
             for groupname, value in instrument.read():
                 # Construct grouping name for this metric value
                 metric_name = "%s*%s" % (groupname, instance_name)
+                if isinstance(value, dict):
+                    # Several values of the group, each with its own name
+                    for value_name, subvalue in sorted(value.items()):
+                        if subvalue is not None:
+                            yield ("%s_%s" % (metric_name, value_name), valuetype, subvalue)
+                    continue
                 # Send metric info
                 yield (metric_name, valuetype, value)
+
+    # Metrics of every bucket closed since the last read, oldest first, with
+    # the end of their bucket as time
+    def read_buckets(self):
+        closed = self.event_time.close(time.time())
+        if closed is None:
+            return
+        current = self.current_bucket
+        for bucket in sorted(set(self.buckets) | set([current])):
+            if bucket is None or bucket >= closed:
+                continue
+            self.switch_bucket(bucket)
+            for metric in self.read_instruments():
+                yield metric + (bucket + self.event_time.bucket_seconds,)
+            # Read instruments keeping their values would read them again
+            self.current_bucket = None
+        if current is not None and current >= closed:
+            self.switch_bucket(current)
+
@@ -0,0 +1,86 @@
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+
+# Space-Saving summary keeping the capacity most frequent keys of a stream in
+# bounded memory. A new key replaces the least frequent one and inherits its
+# count as error, so the count of a key overestimates its true frequency by at
+# most its error. Keys are kept in buckets by count, so each touch is O(1).
+class SpaceSaving(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Estimated count and maximum overestimation of each key
+        self.counts = {}
+        self.errors = {}
+        # Keys by count, and the smallest count
+        self.buckets = {}
+        self.min_count = 0
+
+    # Count an occurrence of key. Returns the key evicted to make room for it,
+    # or None.
+    def touch(self, key):
+        if self.capacity <= 0:
+            return key
+        evicted = None
+        count = self.counts.get(key)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = 0
+                self.errors[key] = 0
+            else:
+                bucket = self.buckets[self.min_count]
+                evicted = bucket.pop()
+                count = self.counts.pop(evicted)
+                del self.errors[evicted]
+                self.errors[key] = count
+                if not bucket:
+                    del self.buckets[count]
+        else:
+            bucket = self.buckets[count]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[count]
+        if count == 0:
+            self.min_count = 1
+        elif count == self.min_count and count not in self.buckets:
+            self.min_count = count + 1
+        count += 1
+        self.counts[key] = count
+        self.buckets.setdefault(count, set()).add(key)
+        return evicted
+
+    # Keys kept
+    def keys(self):
+        return self.counts.keys()
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    # Lower and upper bounds of the true count of key
+    def bounds(self, key):
+        count = self.counts[key]
+        return count - self.errors[key], count
+
+    # Add the counts of another summary, such as the one of a parser shard,
+    # keeping the most frequent keys. Returns the keys left out.
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+            self.errors[key] = self.errors.get(key, 0) + other.errors[key]
+        evicted = []
+        if len(self.counts) > self.capacity:
+            ranked = sorted(self.counts, key=self.counts.get, reverse=True)
+            evicted = ranked[self.capacity:]
+            for key in evicted:
+                del self.counts[key]
+                del self.errors[key]
+        self.buckets = {}
+        for key, count in self.counts.items():
+            self.buckets.setdefault(count, set()).add(key)
+        self.min_count = min(self.buckets) if self.buckets else 0
+        return evicted
@@ -1,21 +1,44 @@
 import re
-from datetime import datetime
 import time
+import hashlib
 import logging
 import logging.handlers
+from prefilter import build_prefilter
+from patterns import get_pattern
+from heavyhitters import SpaceSaving
+from sketches import LogHistogram, HyperLogLog, Moments
+from rates import SlidingWindow, Ewma, window_name
 
 logger = logging.getLogger("GROUPINGTAIL")
 
 NUM32 = 2 ** 32
+# Characters of the sub-keys that are not safe in collectd names
+UNSAFE_CHARACTERS = re.compile("[^A-Za-z0-9_]+")
+# Longest sub-key in metric names, leaving room in the 128 characters of the
+# collectd plugin instance for the File and Match instances and the group
+SUBKEY_MAX_LENGTH = 48
+# Statistics a Summary can read, in their default order
+SUMMARY_STATISTICS = ("count", "sum", "min", "max", "mean", "stddev")
 
 
 # Parser parent class
 class Instrument(object):
-    def __init__(self, regex, maxgroups=64, value_cast=float, groupname=None):
-        # Compiled regex
-        self.test = re.compile(regex)
+    # Values read only cover the lines since the previous read, so they can be
+    # read once per event time bucket
+    per_read = True
+
+    def __init__(self, regex, maxgroups=64, value_cast=float, groupname=None, predicates=None, require=None):
+        # Compiled regex shared with other instruments, or None to work on the
+        # fields of the record regex
+        self.test = get_pattern(regex) if regex is not None else None
+        # Check of literals required by regex, or None
+        self.prefilter = build_prefilter(regex, require) if regex is not None else None
+        # Conditions over the record fields, when working without regex
+        self.predicates = predicates or []
         # Maxim number of groups
         self.maxgroups = maxgroups
+        # Group adding up the values of the groups left out, or None
+        self.othergroup = None
         # Cast function
         self.value_cast = value_cast
         # Regex groupname
@@ -23,8 +46,11 @@ class Instrument(object):
 
         # Data collected and processed
         self.data = None
-        # Groups timestamps
+        # Most active groups, the only ones with data
         self.groups = None
+        # Groups kept by recency, shared by the GroupingTail and tracked by it,
+        # or None to keep the most active groups
+        self.recency = None
 
         # Reset data and groups structures
         self.reset()
@@ -32,53 +58,114 @@ class Instrument(object):
     # Empty bucket and start again
     def reset(self):
         self.data = {}
-        self.groups = {}
+        self.groups = SpaceSaving(self.maxgroups)
 
-    # Mark groups tstamp
-    def touch_group(self, groupname):
-        self.groups[groupname] = datetime.now()
+    # Keep at most maxgroups groups, adding up the values of the groups left
+    # out in othergroup if given
+    def set_groups_limit(self, maxgroups, othergroup=None):
+        self.maxgroups = maxgroups
+        self.othergroup = othergroup
+        self.reset()
 
-    # Trim groups which haven't been touched
-    def trim_groups(self):
-        items = self.groups.items()
-        items.sort()
-        self.groups = dict(items[:self.maxgroups])
+    # Count group activity, leaving out the least active group when over
+    # maxgroups
+    def touch_group(self, groupname):
+        if self.recency is not None:
+            # Already touched by the GroupingTail
+            return
+        evicted = self.groups.touch(groupname)
+        if evicted is not None:
+            self.evict(evicted)
+
+    # Drop the data of a group, adding it up in othergroup if any
+    def evict(self, groupname):
+        value = self.data.pop(groupname, None)
+        if self.othergroup is not None and value is not None:
+            current = self.data.get(self.othergroup)
+            self.data[self.othergroup] = value if current is None else self.merge_value(current, value)
+
+    # Groups with data to read
+    def read_groups(self):
+        if self.recency is not None:
+            # Groups evicted by the GroupingTail have no data left
+            groupnames = [groupname for groupname in self.data if groupname != self.othergroup]
+        else:
+            groupnames = self.groups.keys()
+        if self.othergroup is not None and self.othergroup in self.data:
+            groupnames.append(self.othergroup)
+        return groupnames
 
     # Create newdata with only the members of self.groups and wrap around large integers
     def normalise(self):
         newdata = {}
-        for groupname in self.groups.keys():
+        for groupname in self.read_groups():
             newdata[groupname] = self.value_cast(self.data[groupname])
         self.data = newdata
 
     # Return the current results of the bucket
     def read(self):
-        self.trim_groups()
         self.normalise()
         return self.data.items()
 
+    # Add partial data and groups collected by another copy of this instrument,
+    # such as a parser shard
+    def merge(self, data, groups):
+        for groupname, value in data.items():
+            current = self.data.get(groupname)
+            self.data[groupname] = value if current is None else self.merge_value(current, value)
+            if self.recency is not None and groupname != self.othergroup:
+                self.recency.touch(groupname)
+        for groupname in self.groups.merge(groups):
+            self.evict(groupname)
+
+    # Combine two partial values of a group
+    def merge_value(self, current, value):
+        return current + value
+
+    # Regex groups read by append_data, None standing for the first group
+    def used_groups(self):
+        if self.regex_group:
+            return [self.regex_group]
+        return [None]
+
     # Do actual data analysis from line
     def append_data(self, groupname, line, mo):
         raise NotImplementedError()
 
     # Performs matching over line line and do proper analysis
     def write(self, groupname, line):
+        # Discard lines missing a required literal without running the regex
+        if self.prefilter is not None and not self.prefilter(line):
+            return
         # analise log line
         mo = self.test.match(line)
         # If matching
         if mo is not None:
-            try:
-                # Perform analysis
-                self.append_data(groupname, line, mo)
-            except ValueError:
-                # Contemplated error
-                pass
-            except Exception as e:
-                # The instrument has failed.
-                self.reset()
-            else:
-                # Mark updated group
-                self.touch_group(groupname)
+            self.write_match(groupname, line, mo)
+
+    # Checks predicates over the fields already extracted from line and do
+    # proper analysis
+    def write_fields(self, groupname, line, record):
+        fields = record.groupdict()
+        for predicate in self.predicates:
+            if not predicate(fields):
+                return
+        self.write_match(groupname, line, record)
+
+    # Do proper analysis of a matching line
+    def write_match(self, groupname, line, mo):
+        try:
+            # Perform analysis
+            self.append_data(groupname, line, mo)
+        except ValueError:
+            # Contemplated error
+            pass
+        except Exception as e:
+            # The instrument has failed.
+            self.reset()
+        else:
+            # Mark updated group
+            self.touch_group(groupname)
 
 
 # Incremental Instrument from 0 with value of line matching
@@ -127,6 +214,14 @@ class GaugeThroughput(Instrument):
         self.reset()
         return data
 
+    def used_groups(self):
+        return [name for name in (self.regex_group, self.grouptime) if name is not None]
+
+    def merge_value(self, current, value):
+        # Add bytes transferred and time elapsed
+        return [current[self.value_index] + value[self.value_index],
+                current[self.elapsed_index] + value[self.elapsed_index]]
+
     def append_data(self, groupname, line, mo):
         # Do actual data analysis from line
         if self.regex_group is not None and self.grouptime is not None:
@@ -149,7 +244,7 @@ class GaugeThroughput(Instrument):
         # Create newdata with only the members of self.groups and wrap around large integers
         newdata = {}
         # For all groupingnames
-        for groupname in self.groups.keys():
+        for groupname in self.read_groups():
             # Get throughput info list
             sample_list = self.data[groupname]
             # Get total bytes transferred
@@ -178,6 +273,9 @@ class GaugeTotalThroughput(GaugeThroughput):
         del kwargs["groupother"]
         super(GaugeTotalThroughput, self).__init__(*args, **kwargs)
 
+    def used_groups(self):
+        return [name for name in (self.groupone, self.groupother, self.grouptime) if name is not None]
+
     def append_data(self, groupname, line, mo):
         # Do actual data analysis from line
         value = None
@@ -212,6 +310,9 @@ class CounterInc(Instrument):
         kwargs["value_cast"] = (lambda x: int(x) % NUM32)
         super(CounterInc, self).__init__(*args, **kwargs)
 
+    def used_groups(self):
+        return []
+
     def append_data(self, groupname, line, mo):
         # Update stored data
         self.data[groupname] = self.data.get(groupname, 0) + 1
@@ -227,6 +328,9 @@ class CounterInc(Instrument):
 
 # Not tested
 class CounterSum(Instrument):
+    # Running totals across reads
+    per_read = False
+
     def append_data(self, groupname, line, mo):
         # Do actual data analysis from line
         minimum = self.value_cast(0)
@@ -242,6 +346,9 @@ class CounterSum(Instrument):
 
 # Not tested
 class Max(GaugeInt):
+    def merge_value(self, current, value):
+        return max(current, value)
+
     def append_data(self, groupname, line, mo):
         # Do actual data analysis from line
         if self.regex_group:
@@ -282,3 +389,302 @@ class DeriveCounter(CounterSum):
             samples.append((groupname, value/elapsed))
 
         return samples
+
+
+# Quantiles of the values of each group, estimated with a log bucketed histogram
+# per group. Every quantile is read as a separate value, named after it.
+class Quantiles(Instrument):
+    def __init__(self, *args, **kwargs):
+        # Quantiles read, between 0 and 1
+        self.quantiles = kwargs.pop("quantiles", (0.5, 0.95, 0.99))
+        # Relative accuracy of the estimates, and most buckets per group
+        self.accuracy = kwargs.pop("accuracy", 0.01)
+        self.max_buckets = kwargs.pop("max_buckets", 2048)
+        super(Quantiles, self).__init__(*args, **kwargs)
+
+    def read(self):
+        # Return the current results of the bucket
+        data_list = super(Quantiles, self).read()
+
+        # Empty bucket and start again
+        self.reset()
+        return data_list
+
+    def merge_value(self, current, value):
+        return current.merge(value)
+
+    def append_data(self, groupname, line, mo):
+        # Do actual data analysis from line
+        if self.regex_group:
+            value = self.value_cast(mo.groupdict().get(self.regex_group))
+        else:
+            value = self.value_cast(mo.groups()[0])
+        histogram = self.data.get(groupname)
+        if histogram is None:
+            histogram = self.data[groupname] = LogHistogram(self.accuracy, self.max_buckets)
+        histogram.add(value)
+
+    def normalise(self):
+        # Replace the histogram of each group with its quantiles, by name
+        newdata = {}
+        for groupname in self.read_groups():
+            histogram = self.data[groupname]
+            newdata[groupname] = dict((quantile_name(q), histogram.quantile(q)) for q in self.quantiles)
+        self.data = newdata
+
+
+# Number of distinct values of each group, such as client addresses per tenant,
+# estimated with a HyperLogLog counter per group of a few kilobytes
+class DistinctCount(Instrument):
+    def __init__(self, *args, **kwargs):
+        # Registers of each counter are 2 ** precision bytes
+        self.precision = kwargs.pop("precision", 12)
+        super(DistinctCount, self).__init__(*args, **kwargs)
+
+    def read(self):
+        # Return the current results of the bucket
+        data_list = super(DistinctCount, self).read()
+
+        # Empty bucket and start again
+        self.reset()
+        return data_list
+
+    def merge_value(self, current, value):
+        return current.merge(value)
+
+    def append_data(self, groupname, line, mo):
+        # Do actual data analysis from line
+        if self.regex_group:
+            value = mo.groupdict().get(self.regex_group)
+        else:
+            value = mo.groups()[0]
+        if value is None:
+            # Contemplated error, the group is not touched
+            raise ValueError("No value to count")
+        counter = self.data.get(groupname)
+        if counter is None:
+            counter = self.data[groupname] = HyperLogLog(self.precision)
+        counter.add(value)
+
+    def normalise(self):
+        # Replace the counter of each group with its estimate
+        newdata = {}
+        for groupname in self.read_groups():
+            newdata[groupname] = int(round(self.data[groupname].cardinality()))
+        self.data = newdata
+
+
+# Most frequent sub-keys of each group, such as the hottest request paths of a
+# tenant, with their approximate counts since the last read. Each group keeps a
+# Space-Saving summary of capacity sub-keys, so memory does not depend on the
+# number of distinct sub-keys, and the top ones are read as separate values
+# named after them.
+class TopK(Instrument):
+    def __init__(self, *args, **kwargs):
+        # Sub-keys read per group, and sub-keys tracked per group
+        self.top = kwargs.pop("top", 10)
+        self.capacity = kwargs.pop("capacity", None) or 10 * self.top
+        super(TopK, self).__init__(*args, **kwargs)
+
+    def read(self):
+        # Return the current results of the bucket
+        data_list = super(TopK, self).read()
+
+        # Empty bucket and start again
+        self.reset()
+        return data_list
+
+    def merge_value(self, current, value):
+        current.merge(value)
+        return current
+
+    def append_data(self, groupname, line, mo):
+        # Do actual data analysis from line
+        if self.regex_group:
+            key = mo.groupdict().get(self.regex_group)
+        else:
+            key = mo.groups()[0]
+        if key is None:
+            # Contemplated error, the group is not touched
+            raise ValueError("No sub-key to count")
+        summary = self.data.get(groupname)
+        if summary is None:
+            summary = self.data[groupname] = SpaceSaving(self.capacity)
+        summary.touch(key)
+
+    def normalise(self):
+        # Replace the summary of each group with its top sub-keys and counts
+        newdata = {}
+        for groupname in self.read_groups():
+            counts = self.data[groupname].counts
+            top = sorted(counts, key=lambda key: (-counts[key], key))[:self.top]
+            values = {}
+            for key in top:
+                name = subkey_name(key)
+                # Sub-keys differing only in unsafe characters are added up
+                values[name] = values.get(name, 0) + counts[key]
+            newdata[groupname] = values
+        self.data = newdata
+
+
+# Name of a sub-key in metric names, safe for collectd. Unsafe characters become
+# underscores, trimmed at both ends, and long or empty names are replaced by
+# their start and a hash of the whole sub-key, so that they stay stable and
+# distinct.
+def subkey_name(key):
+    name = UNSAFE_CHARACTERS.sub("_", key).strip("_")
+    if not name or len(name) > SUBKEY_MAX_LENGTH:
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        name = "%s_%s" % (name[:SUBKEY_MAX_LENGTH - 9].rstrip("_"), hashlib.sha1(key).hexdigest()[:8])
+        name = name.lstrip("_")
+    return name
+
+
+# Several statistics of the values of each group from a single match, kept in a
+# compact record per group. The statistics are read together as the values of a
+# single multi-value collectd type, in the order given.
+class Summary(Instrument):
+    def __init__(self, *args, **kwargs):
+        # Statistics read, out of SUMMARY_STATISTICS
+        self.statistics = tuple(kwargs.pop("statistics", SUMMARY_STATISTICS))
+        for statistic in self.statistics:
+            if statistic not in SUMMARY_STATISTICS:
+                raise ValueError("Unknown statistic %r" % statistic)
+        super(Summary, self).__init__(*args, **kwargs)
+
+    def read(self):
+        # Return the current results of the bucket
+        data_list = super(Summary, self).read()
+
+        # Empty bucket and start again
+        self.reset()
+        return data_list
+
+    def merge_value(self, current, value):
+        return current.merge(value)
+
+    def append_data(self, groupname, line, mo):
+        # Do actual data analysis from line
+        if self.regex_group:
+            value = self.value_cast(mo.groupdict().get(self.regex_group))
+        else:
+            value = self.value_cast(mo.groups()[0])
+        moments = self.data.get(groupname)
+        if moments is None:
+            moments = self.data[groupname] = Moments()
+        moments.add(value)
+
+    def normalise(self):
+        # Replace the record of each group with its statistics
+        newdata = {}
+        for groupname in self.read_groups():
+            moments = self.data[groupname]
+            values = {"count": moments.count, "sum": moments.total, "min": moments.minimum,
+                      "max": moments.maximum, "mean": moments.mean, "stddev": moments.stddev()}
+            newdata[groupname] = tuple(values[statistic] for statistic in self.statistics)
+        self.data = newdata
+
+
+# Rate per second of the lines, or of the sum of their values, of each group,
+# smoothed over several windows of seconds across read cycles. Each window of
+# each group is updated once per read, and every window is read as a separate
+# value named after it. Groups are read until their rates go idle, and at most
+# maxgroups groups are kept: the most active across reads, or the ones last
+# seen with recent group retention.
+class SmoothedRate(Instrument):
+    # Class of the per group state of each window
+    window_class = None
+    # Windows span several reads
+    per_read = False
+
+    def __init__(self, *args, **kwargs):
+        # Windows in seconds
+        self.windows = tuple(kwargs.pop("windows", (60, 300, 900)))
+        # Count lines instead of adding up their values
+        self.count_lines = kwargs.pop("count_lines", False)
+        super(SmoothedRate, self).__init__(*args, **kwargs)
+        # Windows of each group, kept across reads
+        self.rates = {}
+        # Groups with windows, by the number of reads they were active in
+        self.rate_groups = SpaceSaving(self.maxgroups)
+        self.last_read = time.time()
+
+    def set_groups_limit(self, maxgroups, othergroup=None):
+        super(SmoothedRate, self).set_groups_limit(maxgroups, othergroup)
+        self.rates = {}
+        self.rate_groups = SpaceSaving(maxgroups)
+
+    def used_groups(self):
+        if self.count_lines:
+            return []
+        return super(SmoothedRate, self).used_groups()
+
+    def append_data(self, groupname, line, mo):
+        # Do actual data analysis from line
+        if self.count_lines:
+            value = 1
+        elif self.regex_group:
+            value = self.value_cast(mo.groupdict().get(self.regex_group))
+        else:
+            value = self.value_cast(mo.groups()[0])
+
+        # Update stored data
+        self.data[groupname] = self.data.get(groupname, 0) + value
+
+    def evict(self, groupname):
+        super(SmoothedRate, self).evict(groupname)
+        # Groups not seen lately are dropped by the GroupingTail, otherwise
+        # the groups with windows are kept across reads by rate_groups
+        if self.recency is not None:
+            self.rates.pop(groupname, None)
+
+    def read(self):
+        # Seconds since the last read, the duration of this cycle
+        now = time.time()
+        elapsed = now - self.last_read
+        self.last_read = now
+        if elapsed <= 0:
+            elapsed = 1.0
+        self.normalise()
+
+        if self.recency is None:
+            for groupname in self.data:
+                evicted = self.rate_groups.touch(groupname)
+                if evicted is not None:
+                    self.rates.pop(evicted, None)
+
+        samples = []
+        for groupname in set(self.rates) | set(self.data):
+            if self.recency is None and groupname not in self.rate_groups:
+                # Active in this read only, and less than the groups kept
+                continue
+            windows = self.rates.get(groupname)
+            if windows is None:
+                windows = self.rates[groupname] = [self.window_class(seconds) for seconds in self.windows]
+            value = self.data.get(groupname, 0)
+            for window in windows:
+                window.update(value, elapsed)
+            if groupname not in self.data and all(window.idle() for window in windows):
+                del self.rates[groupname]
+                continue
+            samples.append((groupname, dict((window_name(window.seconds), window.rate()) for window in windows)))
+
+        # Empty bucket and start again
+        self.reset()
+        return samples
+
+
+# Rates over sliding windows of the last seconds
+class WindowRate(SmoothedRate):
+    window_class = SlidingWindow
+
+
+# Exponentially weighted moving averages of the rates
+class EwmaRate(SmoothedRate):
+    window_class = Ewma
+
+
+# Name of the value of quantile q, such as p95 or p99_9
+def quantile_name(q):
+    return "p" + ("%g" % (q * 100)).replace(".", "_")
@@ -0,0 +1,165 @@
+import re
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Maximum number of groups of a compiled regex
+MAX_GROUPS = getattr(re.sre_compile, "MAXGROUPS", 100) - 1
+# Back references and conditionals, which can not be renumbered in a
+# combined regex
+BACKREFERENCE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P=|\(\?\()')
+# Named group opening
+NAMED_GROUP = re.compile(r'\(\?P<(\w+)>')
+
+
+# True if the regex of an instrument can be part of a combined regex
+def can_combine(instrument):
+    if instrument.test is None:
+        return False
+    # Inline flags would apply to the whole combined regex
+    if instrument.test.flags & ~re.UNICODE:
+        return False
+    return BACKREFERENCE.search(instrument.test.pattern) is None
+
+
+# Rewrite a regex keeping as capturing only the groups in keep (None standing
+# for the first group), renamed with prefix. Other groups become non capturing.
+def rewrite_groups(pattern, keep, prefix):
+    out = []
+    ordinal = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            # Escaped character
+            out.append(pattern[i:i + 2])
+            i += 2
+        elif char == "[":
+            # Character class, copied until its closing bracket
+            end = i + 1
+            if pattern[end:end + 1] == "^":
+                end += 1
+            if pattern[end:end + 1] == "]":
+                end += 1
+            while end < len(pattern) and pattern[end] != "]":
+                end += 2 if pattern[end] == "\\" else 1
+            out.append(pattern[i:end + 1])
+            i = end + 1
+        elif (char == "(" and pattern[i + 1:i + 2] != "?") or pattern.startswith("(?P<", i):
+            # Capturing group, either numbered or named
+            ordinal += 1
+            mo = NAMED_GROUP.match(pattern, i)
+            name = mo.group(1) if mo is not None else None
+            if name is not None and name in keep:
+                out.append("(?P<%s%s>" % (prefix, name))
+            elif ordinal == 1 and None in keep:
+                out.append("(?P<%s>" % prefix)
+            else:
+                out.append("(?:")
+            i = mo.end() if mo is not None else i + 1
+        else:
+            out.append(char)
+            i += 1
+    return "".join(out)
+
+
+# Match object of one instrument regex inside a combined regex match
+class SubMatch(object):
+    def __init__(self, mo, first, names):
+        self.mo = mo
+        # Combined group index of the first group of the instrument regex, or None
+        self.first = first
+        # Instrument regex group names and their combined group indexes
+        self.names = names
+
+    def groups(self):
+        if self.first is None:
+            return ()
+        return (self.mo.group(self.first),)
+
+    def groupdict(self):
+        mo = self.mo
+        return dict((name, mo.group(index)) for name, index in self.names)
+
+
+# Some instrument regexes evaluated with a single match. Each regex becomes an
+# optional lookahead at the start of the line, tagged with a named group telling
+# whether it matched. Only the groups read by the instrument are kept, renamed so
+# they do not clash with the other regexes.
+class CombinedRegex(object):
+    def __init__(self, instruments):
+        parts = []
+        for number, instrument in enumerate(instruments):
+            pattern = rewrite_groups(instrument.test.pattern, instrument.used_groups(), "_m%d_" % number)
+            parts.append("(?:(?=(?P<_m%d>%s))|)" % (number, pattern))
+        self.regex = re.compile("".join(parts))
+
+        # Tag group index, instrument, first group index and names of each regex
+        self.entries = []
+        groupindex = self.regex.groupindex
+        for number, instrument in enumerate(instruments):
+            prefix = "_m%d_" % number
+            first = groupindex.get(prefix)
+            names = [(name, groupindex[prefix + name]) for name in instrument.used_groups()
+                     if name is not None and prefix + name in groupindex]
+            self.entries.append((groupindex["_m%d" % number], instrument, first, names))
+
+    # Match line once and do proper analysis in every instrument that matched
+    def write(self, groupname, line):
+        mo = self.regex.match(line)
+        for tag, instrument, first, names in self.entries:
+            if mo.start(tag) != -1:
+                instrument.write_match(groupname, line, SubMatch(mo, first, names))
+
+
+# All instrument regexes of a GroupingTail evaluated with as few regex matches
+# as the regex engine group limit allows. Instruments whose prefilter rejects
+# the line are left out, so combined regexes are compiled for each set of
+# instruments that may match and cached.
+class CombinedMatcher(object):
+    def __init__(self, instruments, cache_size=256):
+        self.instruments = list(instruments)
+        # Prefilter of each instrument, or None
+        self.prefilters = [instrument.prefilter for instrument in self.instruments]
+        # Combined regexes by bitmask of instruments that may match
+        self.cache = {}
+        self.cache_size = cache_size
+
+    # Combined regexes of the instruments selected by bitmask key
+    def compile(self, key):
+        instruments = [instrument for number, instrument in enumerate(self.instruments) if key & (1 << number)]
+
+        # Split instruments in batches under the groups limit
+        batches = [[]]
+        groups = 0
+        for instrument in instruments:
+            needed = len(instrument.used_groups()) + 1
+            if batches[-1] and groups + needed > MAX_GROUPS:
+                batches.append([])
+                groups = 0
+            batches[-1].append(instrument)
+            groups += needed
+        regexes = [CombinedRegex(batch) for batch in batches]
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = regexes
+        return regexes
+
+    # Match line and do proper analysis in every instrument that matched
+    def write(self, groupname, line):
+        key = 0
+        bit = 1
+        for prefilter in self.prefilters:
+            if prefilter is None or prefilter(line):
+                key |= bit
+            bit <<= 1
+        if not key:
+            return
+
+        regexes = self.cache.get(key)
+        if regexes is None:
+            regexes = self.compile(key)
+        for regex in regexes:
+            regex.write(groupname, line)
@@ -0,0 +1,169 @@
+import os
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# inotify flags, from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Changes of a watched file, and creation of a file in a watched directory
+FILE_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+DIRECTORY_MASK = IN_CREATE | IN_MOVED_TO
+
+# Header of struct inotify_event: wd, mask, cookie and name length
+EVENT_HEADER = struct.Struct("iIII")
+
+
+# Notifier of changes to the files of some sources using Linux inotify. A
+# source is notified when its file is written, truncated, moved or created
+# again, without any system call while it stays idle.
+class InotifyNotifier(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Sources by file watch descriptor
+        self.files = {}
+        # Sources by directory watch descriptor and file name
+        self.directories = {}
+        # Sources to be reported by next poll, starting with new ones that
+        # may have data written before being watched
+        self.changed = set()
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on %s" % path)
+        return wd
+
+    # Watch the file of a source and its directory, to notice the file being
+    # created again after a rotation
+    def watch(self, source):
+        directory, name = os.path.split(os.path.abspath(source.filepath))
+        wd = self.add_watch(directory, DIRECTORY_MASK)
+        self.directories.setdefault(wd, {})[name] = source
+        self.watch_file(source)
+        self.changed.add(source)
+
+    # Watch the current file of a source, if it exists
+    def watch_file(self, source):
+        try:
+            self.files[self.add_watch(source.filepath, FILE_MASK)] = source
+        except OSError:
+            # Watched once created
+            pass
+
+    # Sources changed since last call, without waiting
+    def poll(self):
+        changed = self.changed
+        self.changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                # Nothing more to read
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip("\0")
+                offset += EVENT_HEADER.size + length
+                if wd in self.directories:
+                    source = self.directories[wd].get(name)
+                    if source is not None:
+                        self.watch_file(source)
+                        changed.add(source)
+                elif mask & IN_IGNORED:
+                    # The watched file is gone
+                    self.files.pop(wd, None)
+                elif wd in self.files:
+                    changed.add(self.files[wd])
+        return changed
+
+    # Sources changed, waiting up to timeout seconds for a change
+    def wait(self, timeout):
+        if not self.changed:
+            select.select([self.fd], [], [], timeout)
+        return self.poll()
+
+    # Descriptor readable when changes are waiting, for event loops
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Notifier of changes to the files of some sources checking their status. Used
+# where inotify is not available.
+class PollingNotifier(object):
+    def __init__(self):
+        # Last known status of the file of each source
+        self.status = {}
+        # Sources to be reported by next poll, starting with new ones
+        self.changed = set()
+
+    # Inode, size and modification time of a file, or None if missing
+    @staticmethod
+    def file_status(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    def watch(self, source):
+        self.status[source] = self.file_status(source.filepath)
+        self.changed.add(source)
+
+    # Sources changed since last call, without waiting
+    def poll(self):
+        changed = self.changed
+        self.changed = set()
+        for source, status in self.status.items():
+            current = self.file_status(source.filepath)
+            if current != status:
+                self.status[source] = current
+                changed.add(source)
+        return changed
+
+    # Sources changed, checking again after timeout seconds if none was
+    def wait(self, timeout):
+        changed = self.poll()
+        if not changed:
+            time.sleep(timeout)
+            changed = self.poll()
+        return changed
+
+    def close(self):
+        pass
+
+
+# Notifier of the given kind, "inotify", "poll" or "auto" for inotify when
+# available and polling otherwise
+def create_notifier(kind="auto"):
+    if kind in ("auto", "inotify"):
+        try:
+            return InotifyNotifier()
+        except (OSError, AttributeError, TypeError):
+            if kind == "inotify":
+                raise
+            logger.warning("inotify is not available, polling files for changes")
+    elif kind != "poll":
+        raise ValueError("Unknown change notifier %r" % kind)
+    return PollingNotifier()
@@ -0,0 +1,50 @@
+import re
+import threading
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+
+# Compiled regex shared by every GroupBy and Match using the same pattern. The
+# match of the line being processed is remembered, so identical regexes run
+# once per line however many instruments use them.
+class SharedPattern(object):
+    def __init__(self, regex):
+        compiled = re.compile(regex)
+        self.regex = compiled
+        # Same attributes as a compiled regex
+        self.pattern = compiled.pattern
+        self.flags = compiled.flags
+        self.groups = compiled.groups
+        self.groupindex = compiled.groupindex
+        # Last line matched and its match object, kept together so that
+        # concurrent readers never mix a line with another line's match
+        self.last = (None, None)
+        # Number of matches served from the remembered line
+        self.hits = 0
+
+    def match(self, line):
+        last = self.last
+        # Identity is enough: the remembered line is kept alive, so a new line
+        # can never share its id
+        if last[0] is line:
+            self.hits += 1
+            return last[1]
+        mo = self.regex.match(line)
+        self.last = (line, mo)
+        return mo
+
+
+# Registry of shared patterns by regex
+_patterns = {}
+_patterns_lock = threading.Lock()
+
+
+# Shared compiled pattern of regex
+def get_pattern(regex):
+    with _patterns_lock:
+        pattern = _patterns.get(regex)
+        if pattern is None:
+            pattern = _patterns[regex] = SharedPattern(regex)
+        return pattern
@@ -1,7 +1,10 @@
 import collectd
 import logging
 import logging.handlers
-from conftools import read_config
+from conftools import read_config, get_sources, getConfFirstValue, getConfBool, getConfInt, getConfFloat
+from workers import IngestThread, ProcessPool
+from notify import create_notifier
+from eventloop import EventLoop
 
 log_file_trace_path = "/var/log/collectd_groupingtail_plugin.log"
 
@@ -18,40 +21,143 @@ logger.addHandler(handler)
 
 # List of dictionaries of files and matching configurations
 files = None
+# Ingestion options of the module
+ingestion = None
+# Thread processing sources out of the read callback, either an IngestThread or
+# an EventLoop, when enabled
+ingest_thread = None
+# Processes sharing out the file sources, when enabled
+process_pool = None
+# Notifier of changes of the local file sources, when enabled
+notifier = None
 
 
 # Collectd register_config implementation
 def configure(conf):
-    global files
+    global files, ingestion
     files = read_config(conf)
+    ingestion = dict(
+        # Process sources in a background thread instead of in read()
+        background=getConfBool(conf, 'BackgroundIngestion', False),
+        # Either "threads", with a thread per syslog socket and another one
+        # processing sources, or "loop", a single thread serving everything
+        engine=getConfFirstValue(conf, 'IngestionEngine', "threads").lower(),
+        # Seconds of processing per source before serving the next one
+        budget=float(getConfFirstValue(conf, 'IngestionBudget', 0.5)),
+        # Seconds to wait for new lines once all sources are drained
+        poll_interval=float(getConfFirstValue(conf, 'IngestionPollInterval', 0.5)),
+        # Number of worker processes file sources are shared out to, 0 to
+        # process them all in this process
+        processes=int(getConfFirstValue(conf, 'Processes', 0)),
+        # Kind of notifier of file changes, so that only changed files are
+        # read: "auto", "inotify", "poll", or "none" to read every file
+        notifier=getConfFirstValue(conf, 'ChangeNotifier', "none").lower(),
+        # Limits of the processing of each source in a read callback, so that
+        # a backlog is caught up over several reads, None for no limit
+        read_budget=getConfFloat(conf, 'ReadBudget'),
+        read_max_lines=getConfInt(conf, 'ReadMaxLines'),
+        read_max_bytes=getConfInt(conf, 'ReadMaxBytes')
+    )
+    for source in get_sources(files):
+        # While catching up, process only one line in this many
+        source.sample = int(getConfFirstValue(conf, 'CatchUpSample', 1))
+        # Report how far behind each source is
+        source.report_lag = getConfBool(conf, 'ReportLag', False)
+
+
+# Collectd register_init implementation, threads must be started once the
+# daemon is running
+def init():
+    global ingest_thread, process_pool, notifier
+    if ingestion is None:
+        return
+    notifier_kind = ingestion["notifier"] if ingestion["notifier"] != "none" else None
+    if ingestion["processes"] > 0:
+        process_pool = ProcessPool(files, ingestion["processes"], budget=ingestion["budget"],
+                                   poll_interval=ingestion["poll_interval"], notifier=notifier_kind)
+        process_pool.start()
+    for source in local_sources():
+        source.start_shards()
+    if notifier_kind is not None:
+        notifier = create_notifier(notifier_kind)
+        for source in local_sources():
+            source.watch(notifier)
+    if ingestion["engine"] == "loop":
+        ingest_thread = EventLoop(local_sources(), budget=ingestion["budget"],
+                                  poll_interval=ingestion["poll_interval"], notifier=notifier)
+        ingest_thread.start()
+    elif ingestion["background"]:
+        ingest_thread = IngestThread(local_sources(), budget=ingestion["budget"],
+                                     poll_interval=ingestion["poll_interval"], notifier=notifier)
+        ingest_thread.start()
+
+
+# Collectd register_shutdown implementation
+def shutdown():
+    if ingest_thread is not None:
+        ingest_thread.stop()
+    if process_pool is not None:
+        process_pool.stop()
+    if notifier is not None:
+        notifier.close()
+    for source in local_sources():
+        source.stop_shards()
+
+
+# Sources processed in this process
+def local_sources():
+    sources = get_sources(files)
+    if process_pool is not None:
+        sources = [source for source in sources if source not in process_pool.sources]
+    return sources
 
 
 #
 # Getting mesurements
 #
 def update():
-    # For all matchings in all files update its state
-    for f in files:
-        f["grouping_tail"].update()
+    # Watched sources changed since last read
+    changed = notifier.poll() if notifier is not None else set()
+    # Read every distinct source once, updating all its matchings
+    for source in local_sources():
+        # Sources with lines left by the previous read are carried on
+        if source.watched and source not in changed and source.pending is None:
+            continue
+        source.update(ingestion["read_budget"], ingestion["read_max_lines"], ingestion["read_max_bytes"])
 
 
 # Collectd register_read implementation
 def read():
-    # this might be good in another thread
-    update()
-    for f in files:
+    # Without background ingestion, process new lines now
+    if ingest_thread is None:
+        update()
+    # Metrics of the files processed by worker processes
+    remote_metrics = process_pool.read_metrics() if process_pool is not None else {}
+    for index, f in enumerate(files):
         instance_name = f["instance_name"]
         gt = f["grouping_tail"]
 
-        # Extract metrics info from all groupingtail configurations
-        for metric_name, value_type, value in gt.read_metrics():
+        if process_pool is not None and index in process_pool.indexes:
+            metrics = remote_metrics.get(index, [])
+        else:
+            # Snapshot metrics info from all groupingtail configurations,
+            # without racing with the lines being processed
+            with gt.source.lock:
+                metrics = list(gt.read_metrics())
+
+        for metric in metrics:
+            metric_name, value_type, value = metric[:3]
             # Create collectd value
             v = collectd.Values(
                 plugin='groupingtail',
                 plugin_instance="%s*%s" % (instance_name, metric_name),
                 type=value_type,
-                values=(value,)
+                # Several values at once for multi-value types
+                values=value if isinstance(value, tuple) else (value,)
             )
+            if len(metric) > 3:
+                # Measured in event time, at the end of its bucket
+                v.time = metric[3]
 
             # Dispatch value to collectd daemon
             v.dispatch()
@@ -59,4 +165,6 @@ def read():
 
 # Register functions to collectd daemon
 collectd.register_config(configure)
+collectd.register_init(init)
 collectd.register_read(read)
+collectd.register_shutdown(shutdown)
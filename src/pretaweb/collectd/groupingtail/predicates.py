@@ -0,0 +1,88 @@
+import re
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+#
+# Conditions over the fields extracted once per line by the record regex. They
+# let a Match block select lines without running its own whole line regex:
+#
+#   "request_method in PUT,GET"      value is one of the listed values
+#   "request_method not in HEAD"     value is none of the listed values
+#   "bytes_recvd numeric"            value is an integer number
+#   "status_int = 200"               value equals the given value
+#   "status_int != 200"              value differs from the given value
+#   "request_path ~ ^/v1/AUTH_\w+/"  value matches the given regex
+#
+
+
+# Predicate parent class
+class Predicate(object):
+    def __init__(self, field):
+        # Record regex group name checked by the predicate
+        self.field = field
+
+    # Check the predicate against the fields of a line
+    def __call__(self, fields):
+        value = fields.get(self.field)
+        # Missing or unmatched groups never satisfy a predicate
+        if value is None:
+            return False
+        return self.test(value)
+
+    # Do actual check of field value
+    def test(self, value):
+        raise NotImplementedError()
+
+
+# Value is one of a set of values
+class InPredicate(Predicate):
+    def __init__(self, field, values):
+        super(InPredicate, self).__init__(field)
+        self.values = frozenset(values)
+
+    def test(self, value):
+        return value in self.values
+
+
+# Value is none of a set of values
+class NotInPredicate(InPredicate):
+    def test(self, value):
+        return value not in self.values
+
+
+# Value is an integer number
+class NumericPredicate(Predicate):
+    def test(self, value):
+        return value.isdigit()
+
+
+# Value matches a regex
+class RegexPredicate(Predicate):
+    def __init__(self, field, regex):
+        super(RegexPredicate, self).__init__(field)
+        self.regex = re.compile(regex)
+
+    def test(self, value):
+        return self.regex.match(value) is not None
+
+
+# Build a predicate from its configuration string
+def parse_predicate(text):
+    parts = text.split(None, 2)
+    if len(parts) == 2 and parts[1] == "numeric":
+        return NumericPredicate(parts[0])
+    if len(parts) == 3:
+        field, operator, argument = parts
+        if operator == "in":
+            return InPredicate(field, argument.split(","))
+        if operator == "=":
+            return InPredicate(field, [argument])
+        if operator == "!=":
+            return NotInPredicate(field, [argument])
+        if operator == "~":
+            return RegexPredicate(field, argument)
+        if operator == "not" and argument.startswith("in "):
+            return NotInPredicate(field, argument[3:].strip().split(","))
+    raise ValueError("Invalid predicate %r" % text)
@@ -0,0 +1,67 @@
+import re
+import sre_parse
+import sre_constants
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Shortest literal worth checking before running a regex
+MIN_LITERAL = 2
+
+
+# Cheap check of required literal substrings done before running a regex
+class Prefilter(object):
+    def __init__(self, literals):
+        # Most selective (longest) literals are checked first
+        self.literals = sorted(set(literals), key=len, reverse=True)
+        # Number of lines rejected without running the regex
+        self.rejected = 0
+
+    # True if line may match, False if a required literal is missing
+    def __call__(self, line):
+        for literal in self.literals:
+            if literal not in line:
+                self.rejected += 1
+                return False
+        return True
+
+
+# Literal substrings that any line matching a parsed regex must contain
+def _required_literals(subpattern):
+    literals = []
+    run = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av))
+            continue
+        # Any other element ends the current run of literals
+        literals.append("".join(run))
+        run = []
+        if op == sre_constants.SUBPATTERN:
+            # Group contents are required as a whole
+            literals.extend(_required_literals(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            # Repeated at least once, the body is required
+            literals.extend(_required_literals(av[2]))
+    literals.append("".join(run))
+    return [literal for literal in literals if len(literal) >= MIN_LITERAL]
+
+
+# Literal substrings that any line matching regex must contain
+def required_literals(regex):
+    # Case insensitive literals can not be checked with a plain substring
+    if re.compile(regex).flags & re.IGNORECASE:
+        return []
+    return _required_literals(sre_parse.parse(regex))
+
+
+# Build the prefilter of a regex plus explicitly required literals, or None
+# if there is nothing to check
+def build_prefilter(regex=None, require=None):
+    literals = list(require or [])
+    if regex is not None:
+        literals.extend(required_literals(regex))
+    if not literals:
+        return None
+    return Prefilter(literals)
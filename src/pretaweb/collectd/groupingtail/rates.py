@@ -0,0 +1,70 @@
+import math
+import collections
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Rates this small or smaller are taken as idle
+MIN_RATE = 1e-6
+
+
+# Rate over the last seconds, from the value and duration of each read cycle.
+# Cycles are kept in a ring as long as the window needs them, so every update
+# is O(1) amortised and the ring holds at most seconds / interval cycles.
+class SlidingWindow(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        # Value and duration of each cycle in the window, and their totals
+        self.cycles = collections.deque()
+        self.total = 0
+        self.span = 0.0
+
+    def update(self, value, elapsed):
+        self.cycles.append((value, elapsed))
+        self.total += value
+        self.span += elapsed
+        # Drop the oldest cycles while the rest still cover the window
+        while len(self.cycles) > 1 and self.span - self.cycles[0][1] >= self.seconds:
+            old_value, old_elapsed = self.cycles.popleft()
+            self.total -= old_value
+            self.span -= old_elapsed
+
+    # Rate per second, over the cycles seen so far until the window is full
+    def rate(self):
+        if self.span <= 0:
+            return 0.0
+        return float(self.total) / self.span
+
+    # Nothing left in the window, but rounding residue of float values
+    def idle(self):
+        return abs(self.rate()) <= MIN_RATE
+
+
+# Exponentially weighted moving average of the rate, with a time constant of
+# seconds, as the load average. Older cycles weigh less the longer ago they
+# were, whatever the length of each cycle.
+class Ewma(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.average = None
+
+    def update(self, value, elapsed):
+        rate = float(value) / elapsed
+        if self.average is None:
+            self.average = rate
+        else:
+            self.average += (1 - math.exp(-elapsed / self.seconds)) * (rate - self.average)
+
+    def rate(self):
+        return self.average or 0.0
+
+    def idle(self):
+        return self.rate() <= MIN_RATE
+
+
+# Name of the value of a window of seconds, such as 1m or 90s
+def window_name(seconds):
+    if seconds % 60 == 0:
+        return "%dm" % (seconds / 60)
+    return "%gs" % seconds
@@ -0,0 +1,386 @@
+import os
+import re
+import errno
+import struct
+import select
+import socket
+import threading
+import collections
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Largest syslog datagram received
+DATAGRAM_SIZE = 65535
+# Datagrams drained from the socket before handing them to the buffer
+RECEIVE_BATCH = 256
+# Lines kept in the buffer of a syslog source before dropping the oldest
+BUFFER_LINES = 100000
+# Seconds between checks for shutdown while the socket is idle
+POLL_INTERVAL = 0.5
+# Missing from the socket module of older Pythons, value of Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+# Bytes read from a syslog TCP connection at once
+STREAM_READ_SIZE = 64 * 1024
+# Longest syslog TCP message, longer ones are split
+MAX_MESSAGE_SIZE = 1024 * 1024
+# Pending connections of a syslog TCP listener
+LISTEN_BACKLOG = 128
+# Seconds between checks of a full buffer
+BACKPRESSURE_INTERVAL = 0.05
+# Most bytes spilled to disk by a syslog source before dropping
+SPILL_MAX_BYTES = 1024 * 1024 * 1024
+# Header of a line spilled to disk, its length
+SPILL_HEADER = struct.Struct("<I")
+# Length of an octet counted syslog message, and the start of what may be one
+OCTET_COUNT = re.compile(r"(\d{1,10}) <")
+PARTIAL_OCTET_COUNT = re.compile(r"\d{1,10} ?\Z")
+
+
+# Append only segment file taking the lines received while the memory buffer is
+# full. Lines are read back in order, and once all of them are read the file is
+# emptied to be written from the start again. Lines are stored with their length,
+# so that they may contain newlines.
+class SpillSegment(object):
+    def __init__(self, path, max_bytes=SPILL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Left over from a previous run, only meant to ride out an overload
+        self.fh = open(path, "w+b")
+        self.write_offset = 0
+        self.read_offset = 0
+        # Lines written and not read yet
+        self.lines = 0
+        # Bytes ever written
+        self.spilled = 0
+
+    # Write lines, stopping at max_bytes when bounded. Returns the number of
+    # lines written.
+    def write(self, lines, bounded=True):
+        records = []
+        size = 0
+        for line in lines:
+            record = SPILL_HEADER.pack(len(line)) + line
+            if bounded and self.write_offset + size + len(record) > self.max_bytes:
+                break
+            records.append(record)
+            size += len(record)
+        if records:
+            self.fh.seek(self.write_offset)
+            self.fh.write("".join(records))
+            self.write_offset += size
+            self.lines += len(records)
+            self.spilled += size
+        return len(records)
+
+    # Up to max_lines lines, oldest first
+    def read(self, max_lines):
+        fh = self.fh
+        fh.flush()
+        fh.seek(self.read_offset)
+        lines = []
+        while len(lines) < max_lines and self.read_offset < self.write_offset:
+            length = SPILL_HEADER.unpack(fh.read(SPILL_HEADER.size))[0]
+            lines.append(fh.read(length))
+            self.read_offset += SPILL_HEADER.size + length
+        self.lines -= len(lines)
+        if self.read_offset >= self.write_offset:
+            fh.seek(0)
+            fh.truncate()
+            self.write_offset = self.read_offset = 0
+        return lines
+
+    # Bytes written and not read yet
+    def pending_bytes(self):
+        return self.write_offset - self.read_offset
+
+    def full(self):
+        return self.write_offset >= self.max_bytes
+
+    def close(self):
+        self.fh.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# Bounded buffer of the lines received by a syslog source. Once full, lines are
+# written to the spill segment if any, and the oldest lines are dropped
+# otherwise. Lines are appended and taken in bulk.
+class QueueFile(object):
+    def __init__(self, capacity=BUFFER_LINES, spill=None):
+        self.capacity = capacity
+        self.lines = collections.deque()
+        self.lock = threading.Lock()
+        # SpillSegment taking lines over capacity, or None
+        self.spill = spill
+        # Lines dropped because the buffer was full
+        self.dropped = 0
+
+    # Append lines, dropping lines once full unless drop is False, for senders
+    # that stop once full() instead
+    def extend(self, lines, drop=True):
+        with self.lock:
+            spill = self.spill
+            if spill is not None and spill.lines:
+                # Behind the lines already spilled, to keep the order
+                self.dropped += len(lines) - spill.write(lines, bounded=drop)
+                return
+            self.lines.extend(lines)
+            overflow = len(self.lines) - self.capacity
+            if overflow <= 0:
+                return
+            if spill is not None:
+                newest = [self.lines.pop() for i in xrange(overflow)]
+                newest.reverse()
+                self.dropped += overflow - spill.write(newest, bounded=drop)
+            elif drop:
+                for i in xrange(overflow):
+                    self.lines.popleft()
+                self.dropped += overflow
+
+    # Lines received since last call, followed by up to capacity spilled lines
+    def readlines(self):
+        with self.lock:
+            lines = self.lines
+            self.lines = collections.deque()
+            if self.spill is not None and self.spill.lines:
+                lines.extend(self.spill.read(self.capacity))
+        return lines
+
+    # Lines waiting to be read
+    def __len__(self):
+        return len(self.lines) + (self.spill.lines if self.spill is not None else 0)
+
+    def full(self):
+        if self.spill is not None:
+            return self.spill.full()
+        return len(self.lines) >= self.capacity
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+# Syslog UDP receiver thread. Datagrams are drained from the socket in batches
+# and appended at once to the queue file, so a busy sender costs one lock and
+# one wakeup per batch. rcvbuf sets the socket receive buffer, which absorbs
+# bursts while lines are being processed. With reuseport, other sockets can be
+# bound to the same port, and the kernel shares out the datagrams among them.
+# Without starting the thread, an event loop may wait on filenos and call
+# receive instead.
+class SyslogReceiver(threading.Thread):
+    def __init__(self, host, port, queue, rcvbuf=None, reuseport=False):
+        super(SyslogReceiver, self).__init__(name="groupingtail-syslog-%s" % port)
+        self.setDaemon(True)
+        self.queue = queue
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if rcvbuf is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if reuseport:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        # Datagrams received
+        self.received = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        sock = self.socket
+        while not self.stopped.is_set():
+            readable = select.select([sock], [], [], POLL_INTERVAL)[0]
+            if readable:
+                self.receive(sock.fileno())
+
+    # Descriptors to wait on for receive
+    def filenos(self):
+        return [self.socket.fileno()]
+
+    # Drain a batch of datagrams from the socket, ready on descriptor fd
+    def receive(self, fd):
+        sock = self.socket
+        batch = []
+        while len(batch) < RECEIVE_BATCH:
+            try:
+                data = sock.recv(DATAGRAM_SIZE)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.error("Error receiving syslog datagram: %s", e)
+                break
+            batch.append(data.strip().strip('\x00'))
+        if batch:
+            self.received += len(batch)
+            self.queue.extend(batch)
+
+    # Datagrams dropped by the kernel because the receive buffer was full, from
+    # the drops column of /proc/net/udp, or None where it is not available
+    def kernel_dropped(self):
+        try:
+            inode = str(os.fstat(self.socket.fileno()).st_ino)
+            with open("/proc/net/udp") as fudp:
+                for line in fudp:
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[12])
+        except (IOError, OSError, ValueError, socket.error):
+            pass
+        return None
+
+    # Received, dropped by the buffer and dropped by the kernel counters
+    def stats(self):
+        return self.received, self.queue.dropped, self.kernel_dropped()
+
+    # Stop receiving and release the port, which takes up to POLL_INTERVAL
+    def shutdown(self):
+        self.stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        self.socket.close()
+
+
+# Syslog TCP connection, splitting the stream in messages framed either by
+# octet counting, "length <message>", or by a newline (RFC 6587). The framing is
+# told apart at every message, as syslog messages start with "<" and octet
+# counted ones with their length.
+class StreamConnection(object):
+    def __init__(self, sock):
+        self.socket = sock
+        # Read buffer, reused for every read
+        self.buffer = bytearray(STREAM_READ_SIZE)
+        # Received data not making a complete message yet
+        self.partial = ""
+
+    # Messages complete in data, and the data left
+    @staticmethod
+    def split(data):
+        messages = []
+        pos = 0
+        size = len(data)
+        while pos < size:
+            mo = OCTET_COUNT.match(data, pos)
+            if mo is not None:
+                start = mo.end() - 1
+                end = start + int(mo.group(1))
+                if end > size:
+                    break
+                messages.append(data[start:end])
+                pos = end
+                continue
+            if PARTIAL_OCTET_COUNT.match(data, pos):
+                # Length not complete yet
+                break
+            end_of_line = data.find("\n", pos)
+            if end_of_line == -1:
+                break
+            messages.append(data[pos:end_of_line])
+            pos = end_of_line + 1
+        return messages, data[pos:]
+
+    # Messages received, or None once the connection is closed
+    def receive(self):
+        try:
+            count = self.socket.recv_into(self.buffer)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            logger.error("Error receiving syslog stream: %s", e)
+            count = 0
+        if count == 0:
+            # Closed, what is left is the last message
+            last = self.partial
+            self.partial = ""
+            return [last] if last.strip() else None
+        messages, self.partial = self.split(self.partial + str(self.buffer[:count]))
+        if len(self.partial) > MAX_MESSAGE_SIZE:
+            # Never framed, deliver it rather than growing without bound
+            messages.append(self.partial)
+            self.partial = ""
+        return messages
+
+    def close(self):
+        self.socket.close()
+
+
+# Syslog TCP receiver thread, accepting any number of connections. Received
+# messages are appended to the queue file, and once it is full sockets are not
+# read until it has room again, so senders are slowed down by TCP flow control
+# instead of messages being dropped. Like SyslogReceiver, an event loop may serve
+# it instead of the thread.
+class TcpSyslogReceiver(threading.Thread):
+    def __init__(self, host, port, queue, rcvbuf=None):
+        super(TcpSyslogReceiver, self).__init__(name="groupingtail-syslog-tcp-%s" % port)
+        self.setDaemon(True)
+        self.queue = queue
+        self.rcvbuf = rcvbuf
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if rcvbuf is not None:
+            # Inherited by accepted connections
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.socket.bind((host, port))
+        self.socket.listen(LISTEN_BACKLOG)
+        self.socket.setblocking(False)
+        # Connections by descriptor
+        self.connections = {}
+        # Messages received
+        self.received = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            fds = self.filenos()
+            if not fds:
+                # Buffer full
+                self.stopped.wait(BACKPRESSURE_INTERVAL)
+                continue
+            for fd in select.select(fds, [], [], POLL_INTERVAL)[0]:
+                self.receive(fd)
+
+    # Descriptors to wait on for receive, none while the buffer is full
+    def filenos(self):
+        if self.queue.full():
+            return []
+        return [self.socket.fileno()] + list(self.connections)
+
+    # Accept connections or receive messages, ready on descriptor fd
+    def receive(self, fd):
+        if fd == self.socket.fileno():
+            self.accept()
+            return
+        connection = self.connections[fd]
+        messages = connection.receive()
+        if messages is None:
+            del self.connections[fd]
+            connection.close()
+            return
+        if messages:
+            self.received += len(messages)
+            self.queue.extend([message.strip().strip('\x00') for message in messages], drop=False)
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.error("Error accepting syslog connection: %s", e)
+                return
+            sock.setblocking(False)
+            self.connections[sock.fileno()] = StreamConnection(sock)
+
+    # Received, dropped by the buffer and dropped by the kernel counters. Flow
+    # control slows senders down instead of dropping.
+    def stats(self):
+        return self.received, self.queue.dropped, None
+
+    # Stop receiving and release the port, which takes up to POLL_INTERVAL
+    def shutdown(self):
+        self.stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+        self.socket.close()
@@ -0,0 +1,60 @@
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+
+# Groups of a GroupingTail kept by recency. Each group is stamped with the read
+# cycle it was last seen in, once per line for all the instruments, and groups
+# are bucketed by cycle, so a touch is a dictionary lookup in the common case of
+# a group already seen in the cycle, and eviction walks the buckets from the
+# oldest cycle without sorting. Groups seen in the same cycle are equally recent.
+class RecentGroups(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Cycle each group was last seen in
+        self.last_seen = {}
+        # Groups by cycle last seen in
+        self.cycles = {}
+        # Current cycle, and the oldest one that may have groups
+        self.cycle = 0
+        self.oldest = 0
+
+    def touch(self, groupname):
+        cycle = self.cycle
+        last = self.last_seen.get(groupname)
+        if last == cycle:
+            return
+        if last is not None:
+            bucket = self.cycles[last]
+            bucket.discard(groupname)
+            if not bucket:
+                del self.cycles[last]
+        self.last_seen[groupname] = cycle
+        self.cycles.setdefault(cycle, set()).add(groupname)
+
+    def __contains__(self, groupname):
+        return groupname in self.last_seen
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    # Close the current cycle, evicting the least recently seen groups over
+    # capacity. Returns the groups evicted.
+    def trim(self):
+        evicted = []
+        excess = len(self.last_seen) - self.capacity
+        while excess > 0:
+            bucket = self.cycles.get(self.oldest)
+            while bucket and excess > 0:
+                groupname = bucket.pop()
+                del self.last_seen[groupname]
+                evicted.append(groupname)
+                excess -= 1
+            if not bucket:
+                self.cycles.pop(self.oldest, None)
+                self.oldest += 1
+        while self.oldest < self.cycle and self.oldest not in self.cycles:
+            self.oldest += 1
+        self.cycle += 1
+        return evicted
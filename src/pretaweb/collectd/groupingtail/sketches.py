@@ -0,0 +1,180 @@
+import math
+import struct
+import hashlib
+import logging
+import logging.handlers
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Values this small or smaller are counted together as zero
+MIN_VALUE = 1e-9
+# Bits of the hash of a value used by HyperLogLog
+HASH_BITS = 64
+
+
+# Histogram with logarithmic buckets, so that every quantile is estimated with
+# the same relative accuracy whatever the range of the values (as DDSketch). A
+# value v goes to bucket ceil(log(v) / log(gamma)), in O(1). Histograms with
+# the same accuracy merge exactly by adding bucket counts. Past max_buckets the
+# lowest buckets are folded together, losing accuracy only on the low end.
+class LogHistogram(object):
+    def __init__(self, accuracy=0.01, max_buckets=2048):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        gamma = (1 + accuracy) / (1 - accuracy)
+        self.gamma = gamma
+        self.inverse_log_gamma = 1 / math.log(gamma)
+        # Counts by bucket index, and of values counted as zero
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= MIN_VALUE:
+            self.zero_count += 1
+            return
+        index = int(math.ceil(math.log(value) * self.inverse_log_gamma))
+        buckets = self.buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        if len(buckets) > self.max_buckets:
+            self.collapse()
+
+    # Fold the lowest buckets into the lowest one kept
+    def collapse(self):
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets
+        if excess <= 0:
+            return
+        lowest = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[lowest] += self.buckets.pop(index)
+
+    # Add the values counted by another histogram of the same accuracy
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.collapse()
+        return self
+
+    # Estimate of the q quantile, 0 <= q <= 1, or None without values
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # Middle of the bucket, in relative terms
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+# HyperLogLog counter of the distinct values of a stream, in 2 ** precision one
+# byte registers whatever the number of values. The standard error of the
+# estimate is about 1.04 / sqrt(2 ** precision), 1.6% with the default 4096
+# registers. Counters of the same precision merge exactly by keeping the
+# highest of each register.
+class HyperLogLog(object):
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16, not %r" % precision)
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        if self.size >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / self.size)
+        else:
+            self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.size]
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        hashed = struct.unpack("<Q", hashlib.sha1(str(value)).digest()[:8])[0]
+        # First bits choose the register, the position of the first one bit in
+        # the rest is the rank kept in it
+        index = hashed >> (HASH_BITS - self.precision)
+        rest = hashed & ((1 << (HASH_BITS - self.precision)) - 1)
+        rank = HASH_BITS - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    # Add the values counted by another counter of the same precision
+    def merge(self, other):
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+        return self
+
+    # Estimate of the number of distinct values added
+    def cardinality(self):
+        size = self.size
+        estimate = self.alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        if estimate <= 2.5 * size:
+            # Small range correction, linear counting of the empty registers
+            empty = self.registers.count(b"\x00")
+            if empty:
+                estimate = size * math.log(float(size) / empty)
+        return estimate
+
+
+# Count, sum, minimum, maximum, mean and variance of a stream of values, updated
+# in one pass with Welford's method, which stays accurate where the sum of
+# squares would not. Summaries merge exactly with the parallel variant of it.
+class Moments(object):
+    __slots__ = ("count", "total", "minimum", "maximum", "mean", "m2")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.mean = 0.0
+        # Sum of squared differences from the mean
+        self.m2 = 0.0
+
+    def __getstate__(self):
+        return self.count, self.total, self.minimum, self.maximum, self.mean, self.m2
+
+    def __setstate__(self, state):
+        self.count, self.total, self.minimum, self.maximum, self.mean, self.m2 = state
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    # Add the values summarised by other
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.__setstate__(other.__getstate__())
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        return self
+
+    # Population standard deviation
+    def stddev(self):
+        if self.count == 0:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
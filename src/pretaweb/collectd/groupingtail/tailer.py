@@ -0,0 +1,134 @@
+import os
+import io
+import logging
+import logging.handlers
+from checkpoints import write_checkpoint
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Bytes read from the file at once
+CHUNK_SIZE = 1024 * 1024
+
+
+# Tail of a log file reading appended data in large chunks and splitting lines
+# in bulk. The file is kept open, so after a rotation by rename the rest of the
+# old file is read before moving to the new one, and a file truncated in place
+# (copytruncate) is read again from the start. Lines are returned without their
+# end of line, and a trailing line is only returned once it is complete. The
+# offset reached is checkpointed in offset_file, with the same format as
+# Pygtail, once per readlines. Reading starts at checkpoint if given, or else at
+# the checkpoint of offset_file.
+class ChunkedTail(object):
+    def __init__(self, filename, offset_file=None, chunk_size=CHUNK_SIZE, checkpoint=None):
+        self.filename = filename
+        self.offset_file = offset_file
+        self.chunk_size = chunk_size
+        # Open file, its inode, and offset of the first byte not returned yet
+        # as part of a complete line
+        self.fh = None
+        self.inode = None
+        self.offset = 0
+        # Bytes read after the last end of line
+        self.partial = ""
+        # Checkpoint last written
+        self.checkpoint = None
+
+        self.open(checkpoint if checkpoint is not None else self.read_offset())
+
+    # Checkpoint stored in the offset file as (inode, offset), or None
+    def read_offset(self):
+        if self.offset_file is None:
+            return None
+        try:
+            with open(self.offset_file) as foffset:
+                inode, offset = foffset.read().split()[:2]
+            return int(inode), int(offset)
+        except (IOError, ValueError):
+            return None
+
+    # Store the offset reached, replacing the offset file atomically. An
+    # unchanged checkpoint is only touched, so its age tells when it was last
+    # known to be current.
+    def write_offset(self):
+        checkpoint = (self.inode, self.offset)
+        if self.offset_file is None or self.inode is None:
+            return
+        if checkpoint == self.checkpoint:
+            os.utime(self.offset_file, None)
+            return
+        write_checkpoint(self.offset_file, checkpoint)
+        self.checkpoint = checkpoint
+
+    # Open the file, resuming at checkpoint if it belongs to the same file.
+    # Returns False if the file does not exist.
+    def open(self, checkpoint=None):
+        try:
+            # Unbuffered, reads go straight to the file and never stick at EOF
+            fh = io.open(self.filename, "rb", buffering=0)
+        except IOError:
+            return False
+        stat = os.fstat(fh.fileno())
+        offset = 0
+        if checkpoint is not None and checkpoint[0] == stat.st_ino and checkpoint[1] <= stat.st_size:
+            offset = checkpoint[1]
+        fh.seek(offset)
+        self.fh = fh
+        self.inode = stat.st_ino
+        self.offset = offset
+        self.partial = ""
+        return True
+
+    # True if the path now names another file than the open one
+    def rotated(self):
+        try:
+            return os.stat(self.filename).st_ino != self.inode
+        except OSError:
+            # Not created again yet, keep reading the old file
+            return False
+
+    # Complete lines appended to the open file since last read
+    def read_available(self):
+        fh = self.fh
+        # Truncated in place: start again from the beginning
+        if os.fstat(fh.fileno()).st_size < fh.tell():
+            fh.seek(0)
+            self.offset = 0
+            self.partial = ""
+        while True:
+            chunk = fh.read(self.chunk_size)
+            if not chunk:
+                break
+            lines = (self.partial + chunk).split("\n")
+            self.partial = lines.pop()
+            self.offset = fh.tell() - len(self.partial)
+            for line in lines:
+                yield line
+
+    # New complete lines of the log, following rotations
+    def readlines(self):
+        if self.fh is None and not self.open():
+            return
+        for line in self.read_available():
+            yield line
+        if self.rotated():
+            # The old file is over, its trailing line is complete
+            if self.partial:
+                yield self.partial
+            self.fh.close()
+            self.fh = None
+            if self.open():
+                for line in self.read_available():
+                    yield line
+        self.write_offset()
+
+    # Bytes of the open file not read yet. Lines of the last chunk read count
+    # as read before they are returned.
+    def lag(self):
+        if self.fh is None:
+            return 0
+        return max(os.fstat(self.fh.fileno()).st_size - self.offset, 0)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
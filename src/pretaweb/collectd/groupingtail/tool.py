@@ -1,7 +1,7 @@
 import optparse
 import json
 from time import sleep
-from pretaweb.collectd.groupingtail.conftools import read_config
+from pretaweb.collectd.groupingtail.conftools import read_config, get_sources
 
 
 # small commandline version for debugging. Takes a .json file with the config
@@ -30,15 +30,23 @@ def main():
     while True:
         sleep(5)
         # update
-        for f in files:
-            f["grouping_tail"].update()
+        for source in get_sources(files):
+            source.update()
 
         for f in files:
             instance_name = f["instance_name"]
             gt = f["grouping_tail"]
 
-            for metric_name, value_type, value in gt.read_metrics():
-                print "%s.%s: %s=%s" % (instance_name, metric_name, value_type, value)
+            for metric in gt.read_metrics():
+                metric_name, value_type, value = metric[:3]
+                if len(metric) > 3:
+                    # Measured in event time, at the end of its bucket
+                    print "%s.%s: %s=%s at %s" % (instance_name, metric_name, value_type, value, metric[3])
+                else:
+                    print "%s.%s: %s=%s" % (instance_name, metric_name, value_type, value)
+
+            for name, rejected in gt.prefilter_stats():
+                print "%s.%s: prefilter rejected=%s" % (instance_name, name, rejected)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,316 @@
+import threading
+import multiprocessing
+import weakref
+import Queue
+import logging
+import logging.handlers
+from notify import create_notifier
+from receiver import QueueFile, SyslogReceiver, POLL_INTERVAL
+
+logger = logging.getLogger("GROUPINGTAIL")
+
+# Message asking a parser shard for its partial instrument state
+COLLECT = "collect"
+# Batches of lines waiting for each parser shard before the reader blocks
+SHARD_QUEUE_BATCHES = 64
+
+
+# Thread reading and processing sources continuously, out of the collectd read
+# callback. Sources are served round robin, each one for at most budget seconds
+# per pass, so a busy source can not starve the others. With a notifier, watched
+# sources are only read when they change, as soon as they do.
+class IngestThread(threading.Thread):
+    def __init__(self, sources, budget=0.5, poll_interval=0.5, notifier=None):
+        super(IngestThread, self).__init__(name="groupingtail-ingest")
+        self.setDaemon(True)
+        self.sources = list(sources)
+        # Seconds of processing per source and pass
+        self.budget = budget
+        # Seconds to wait when every source is drained
+        self.poll_interval = poll_interval
+        # Notifier of changes of the watched sources, or None
+        self.notifier = notifier
+        self.stopped = threading.Event()
+
+    def run(self):
+        # Watched sources to be read in the next pass
+        changed = set()
+        if self.notifier is not None:
+            changed = self.notifier.poll()
+        while not self.stopped.is_set():
+            # Sources with lines left when their budget ran out
+            unfinished = set()
+            for source in self.sources:
+                if source.watched and source not in changed:
+                    continue
+                try:
+                    if not source.update(self.budget):
+                        unfinished.add(source)
+                except Exception:
+                    # A failing source must not stop ingestion of the others
+                    logger.exception("Error updating %s", source.filepath)
+            if self.notifier is not None:
+                # Wait for changes only when nothing is left to process
+                changed = self.notifier.poll() if unfinished else self.notifier.wait(self.poll_interval)
+                changed |= unfinished
+            elif not unfinished:
+                self.stopped.wait(self.poll_interval)
+            else:
+                changed = unfinished
+
+    def stop(self):
+        self.stopped.set()
+
+
+# Process reading and processing some sources of the configured files. Metrics
+# are read in the worker, so instruments keep their semantics, and only the
+# resulting values are sent back to the parent.
+class SourceProcess(object):
+    def __init__(self, files, budget=0.5, poll_interval=0.5, notifier=None):
+        # Configured files handled by this process, by configuration index
+        self.files = list(files)
+        self.budget = budget
+        self.poll_interval = poll_interval
+        # Kind of change notifier created in the process, or None
+        self.notifier = notifier
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.run, args=(child_conn,))
+        self.process.daemon = True
+
+    # Sources of the files handled by this process
+    @property
+    def sources(self):
+        sources = []
+        for index, f in self.files:
+            if f["grouping_tail"].source not in sources:
+                sources.append(f["grouping_tail"].source)
+        return sources
+
+    def start(self):
+        self.process.start()
+
+    # Worker process main loop, answering metric requests from the parent
+    def run(self, conn):
+        # Keep only the child end, so that the parent going away is noticed
+        self.conn.close()
+        notifier = None
+        if self.notifier is not None:
+            notifier = create_notifier(self.notifier)
+            for source in self.sources:
+                source.watch(notifier)
+        ingest_thread = IngestThread(self.sources, budget=self.budget, poll_interval=self.poll_interval,
+                                     notifier=notifier)
+        ingest_thread.start()
+        while True:
+            try:
+                conn.recv()
+            except EOFError:
+                # The parent has gone away
+                break
+            metrics = []
+            for index, f in self.files:
+                gt = f["grouping_tail"]
+                with gt.source.lock:
+                    metrics.append((index, list(gt.read_metrics())))
+            conn.send(metrics)
+        ingest_thread.stop()
+
+    # Ask for metrics, answered by receive_metrics
+    def request_metrics(self):
+        # Drop answers that arrived too late for a previous request
+        while self.conn.poll():
+            self.conn.recv()
+        self.conn.send("read")
+
+    # Metrics of each file handled by this process, by configuration index,
+    # or None if the process did not answer in time
+    def receive_metrics(self, timeout):
+        if not self.conn.poll(timeout):
+            return None
+        return dict(self.conn.recv())
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(1)
+
+
+# Pool of processes sharing out the file sources of a configuration, so that
+# parsing is spread across cores
+class ProcessPool(object):
+    def __init__(self, files, processes, budget=0.5, poll_interval=0.5, timeout=2.0, notifier=None):
+        # Seconds to wait for each process to send its metrics
+        self.timeout = timeout
+
+        # Files grouped by source, so that a shared source stays in one process
+        groups = []
+        for index, f in enumerate(files):
+            source = f["grouping_tail"].source
+            # Syslog servers run in threads of this process, which are not
+            # carried over to forked processes, and sharded sources already
+            # have their own processes
+            if hasattr(source, "server") or source.shard_count > 0:
+                continue
+            for group in groups:
+                if group[0] is source:
+                    group[1].append((index, f))
+                    break
+            else:
+                groups.append((source, [(index, f)]))
+
+        shares = [[] for i in range(min(processes, len(groups)))]
+        # Files handled by the pool, by configuration index
+        self.indexes = set()
+        for number, (source, group_files) in enumerate(groups):
+            shares[number % len(shares)].extend(group_files)
+            self.indexes.update(index for index, f in group_files)
+        self.processes = [SourceProcess(share, budget, poll_interval, notifier) for share in shares]
+
+    # Sources read by the pool
+    @property
+    def sources(self):
+        return [source for process in self.processes for source in process.sources]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    # Metrics of every file handled by the pool, by configuration index
+    def read_metrics(self):
+        # Ask every process first, so that they all work at the same time
+        for process in self.processes:
+            process.request_metrics()
+        metrics = {}
+        for process in self.processes:
+            received = process.receive_metrics(self.timeout)
+            if received is None:
+                logger.error("Process %s did not send its metrics", process.process.pid)
+                continue
+            metrics.update(received)
+        return metrics
+
+    def stop(self):
+        for process in self.processes:
+            process.stop()
+
+
+# Parser processes sharing out the lines of a single source. The source reads
+# the lines and deals batches round robin to the shards, each one running the
+# GroupBy and Match regexes of all the source GroupingTails. At read time the
+# partial state of every shard instrument is merged into the source instruments.
+class ShardPool(object):
+    def __init__(self, source, shards, timeout=2.0):
+        # Weak, the source owns its shards
+        self.source = weakref.proxy(source)
+        # Seconds to wait for each shard to send its partial state
+        self.timeout = timeout
+        self.inqueues = [multiprocessing.Queue(SHARD_QUEUE_BATCHES) for i in range(shards)]
+        self.outqueues = [multiprocessing.Queue() for i in range(shards)]
+        self.processes = []
+        for inqueue, outqueue in zip(self.inqueues, self.outqueues):
+            process = multiprocessing.Process(target=self.run, args=(inqueue, outqueue))
+            process.daemon = True
+            self.processes.append(process)
+        # Shard receiving the next batch
+        self.next_shard = 0
+
+    # Instruments of every GroupingTail of the source, in a stable order
+    def instruments(self):
+        return [match["instrument"] for gt in self.source.grouping_tails for match in gt.match_definitions]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    # Shard process main loop
+    def run(self, inqueue, outqueue):
+        grouping_tails = self.source.grouping_tails
+        instruments = self.instruments()
+        # Shards only collect what they process themselves
+        for instrument in instruments:
+            instrument.reset()
+        while True:
+            batch = inqueue.get()
+            if batch is None:
+                break
+            if batch == COLLECT:
+                outqueue.put([(instrument.data, instrument.groups) for instrument in instruments])
+                for instrument in instruments:
+                    instrument.reset()
+                continue
+            for line in batch:
+                for grouping_tail in grouping_tails:
+                    grouping_tail.process_line(line)
+
+    # Hand a batch of lines to the next shard
+    def send(self, batch):
+        self.inqueues[self.next_shard].put(batch)
+        self.next_shard = (self.next_shard + 1) % len(self.inqueues)
+
+    # Merge the partial state of every shard into the source instruments.
+    # Shards answer after processing all the batches sent before.
+    def collect(self):
+        for inqueue in self.inqueues:
+            inqueue.put(COLLECT)
+        instruments = self.instruments()
+        for outqueue in self.outqueues:
+            try:
+                partials = outqueue.get(timeout=self.timeout)
+            except Queue.Empty:
+                # Merged at the next collect instead
+                logger.error("Parser shard of %s did not send its state", self.source.filepath)
+                continue
+            for instrument, (data, groups) in zip(instruments, partials):
+                instrument.merge(data, groups)
+
+    def stop(self):
+        for inqueue in self.inqueues:
+            inqueue.put(None)
+        for process in self.processes:
+            process.join(self.timeout)
+
+
+# Processes receiving a syslog url on their own SO_REUSEPORT socket, bound to the
+# same port as the source socket, so that the kernel shares out the datagrams
+# and both receiving and parsing scale with cores. Each process parses what it
+# receives with the GroupBy and Match regexes of all the source GroupingTails,
+# and at read time its partial instrument state is merged like the one of a
+# parser shard.
+class ReceiverPool(ShardPool):
+    def __init__(self, source, sockets, host, port, rcvbuf=None, buffer_lines=None, timeout=2.0):
+        self.address = (host, port)
+        self.rcvbuf = rcvbuf
+        self.buffer_lines = buffer_lines
+        super(ReceiverPool, self).__init__(source, sockets, timeout)
+
+    # Parse the lines received since last call
+    def process(self, grouping_tails, queue):
+        for line in queue.readlines():
+            for grouping_tail in grouping_tails:
+                grouping_tail.process_line(line)
+
+    # Receiver process main loop
+    def run(self, inqueue, outqueue):
+        # The source socket inherited from the parent is left to the parent
+        queue = QueueFile(self.buffer_lines)
+        receiver = SyslogReceiver(self.address[0], self.address[1], queue, rcvbuf=self.rcvbuf, reuseport=True)
+        receiver.start()
+        grouping_tails = self.source.grouping_tails
+        instruments = self.instruments()
+        # Receivers only collect what they process themselves
+        for instrument in instruments:
+            instrument.reset()
+        while True:
+            self.process(grouping_tails, queue)
+            try:
+                message = inqueue.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            # Answer with every line received up to the message
+            self.process(grouping_tails, queue)
+            if message is None:
+                break
+            if message == COLLECT:
+                outqueue.put([(instrument.data, instrument.groups) for instrument in instruments])
+                for instrument in instruments:
+                    instrument.reset()
+        receiver.shutdown()
@@ -99,6 +99,81 @@ class TestConfig(TestGroupingTail):
         read()
 
 
+    @staticmethod
+    def test_shared_source_config():
+        """
+            Test that File blocks with the same path share a single reader.
+        """
+        from pretaweb.collectd.groupingtail.conftools import read_config, get_sources
+        config = CollectdConfig('root', (), (
+            ('File', SIMPLE_LOG_FILE, (
+                ('Instance', 'digits', ()),
+                ('GroupBy', '^(\\d)', ()),
+                ('Match', (), (
+                    ('Instance', 'requests', ()),
+                    ('Regex', '.', ()),
+                    ('DSType', 'CounterInc', ()),
+                    ('Type', 'counter', ()),
+                )),
+            )),
+            ('File', SIMPLE_LOG_FILE, (
+                ('Instance', 'letters', ()),
+                ('GroupBy', '^(\\D)', ()),
+                ('Match', (), (
+                    ('Instance', 'requests', ()),
+                    ('Regex', '.', ()),
+                    ('DSType', 'CounterInc', ()),
+                    ('Type', 'counter', ()),
+                )),
+            )),
+        ))
+
+        files = read_config(config)
+        sources = get_sources(files)
+        assert_equal(len(sources), 1)
+        assert_equal(len(sources[0].grouping_tails), 2)
+
+        sources[0].update()
+        digits = files[0]["grouping_tail"].match_definitions[0]["instrument"]
+        letters = files[1]["grouping_tail"].match_definitions[0]["instrument"]
+        assert_equal(digits.data, {'1': 1, '2': 2, '3': 3, '8': 1})
+        assert_equal(letters.data, {'w': 3, 'y': 1})
+
+    @staticmethod
+    def test_event_time_config():
+        """
+            Test that event time refuses instruments keeping values across reads and shards.
+        """
+        from nose.tools import assert_raises
+        from pretaweb.collectd.groupingtail.conftools import read_config
+
+        def event_time_file(dstype, *options):
+            return ('File', SIMPLE_LOG_FILE, options + (
+                ('Instance', 'digits', ()),
+                ('GroupBy', '^(?P<ts>\\d+) (?P<digit>\\d)', ()),
+                ('GroupName', 'digit', ()),
+                ('EventTimeField', 'ts', ()),
+                ('Match', (), (
+                    ('Instance', 'requests', ()),
+                    ('Regex', '.', ()),
+                    ('DSType', dstype, ()),
+                    ('Type', 'counter', ()),
+                )),
+            ))
+
+        files = read_config(CollectdConfig('root', (), (event_time_file('CounterInc'),)))
+        assert_true(files[0]["grouping_tail"].event_time is not None)
+        for dstype in ('CounterSumInt', 'DeriveCounter', 'WindowRate', 'EwmaRate'):
+            assert_raises(ValueError, read_config, CollectdConfig('root', (), (event_time_file(dstype),)))
+        # Shards given by a later File of the same path
+        sharded = ('File', SIMPLE_LOG_FILE, (
+            ('Instance', 'sharded', ()),
+            ('GroupBy', '^(\\d)', ()),
+            ('Shards', 2, ()),
+        ))
+        assert_raises(ValueError, read_config, CollectdConfig('root', (), (event_time_file('CounterInc'), sharded)))
+
+
 class TestFunction(TestGroupingTail):
 
     @staticmethod
@@ -214,6 +289,37 @@ class TestFunction(TestGroupingTail):
             assert_equal(value, key_value)
 
 
+    @staticmethod
+    def test_watched_backlog_config():
+        """
+            Test that a watched file left behind is carried on without new writes.
+        """
+        from pretaweb.collectd.groupingtail import plugin
+        new_log = tempfile.NamedTemporaryFile()
+        config = CollectdConfig('root', (), (
+            ('ChangeNotifier', 'poll', ()),
+            ('ReadMaxLines', 600, ()),
+            ('File', new_log.name, (
+                ('Instance', 'digits', ()),
+                ('GroupBy', '^(\\d)', ()),
+                ('Match', (), (
+                    ('Instance', 'requests', ()),
+                    ('Regex', '.', ()),
+                    ('DSType', 'CounterInc', ()),
+                    ('Type', 'counter', ()),
+                )),
+            )),
+        ))
+        plugin.configure(config)
+        plugin.init()
+        new_log.write("1 line\n" * 3000)
+        new_log.flush()
+        counter_inc = plugin.files[0]["grouping_tail"].match_definitions[0]["instrument"]
+        for i in range(3):
+            plugin.update()
+        plugin.shutdown()
+        assert_equal(counter_inc.data, {'1': 3000})
+
     @staticmethod
     def test_counter_sum_config():
         from pretaweb.collectd.groupingtail.plugin import configure, read
@@ -240,6 +346,604 @@ class TestFunction(TestGroupingTail):
 
 
 
+    @staticmethod
+    def test_record_fields():
+        """
+            Test instruments working on the fields of the GroupBy regex.
+        """
+        from pretaweb.collectd.groupingtail.predicates import parse_predicate
+
+        record_by = '^\\S+ \\[[^]]*\\] (?P<host>\\S+) (?P<method>\\S+) \\S+ \\S+ (?P<status>\\d+) (?P<bytes>\\S+) '
+        counter_sum = CounterSum(None, groupname="bytes", value_cast=int_cast,
+                                 predicates=[parse_predicate("method in PUT,GET"),
+                                             parse_predicate("bytes numeric")])
+        counter_inc = CounterInc(None, predicates=[parse_predicate("method = POST")])
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, record_by)
+        grouping_tail.groupbygroup = "host"
+        grouping_tail.add_match('tx', 'counter', counter_sum)
+        grouping_tail.add_match('posts', 'counter', counter_inc)
+        grouping_tail.update()
+
+        assert_equal(counter_sum.data, {'domain_com': 19600})
+        assert_equal(counter_inc.data, {})
+
+    @staticmethod
+    def test_parse_predicate():
+        """
+            Test predicates configuration strings.
+        """
+        from pretaweb.collectd.groupingtail.predicates import parse_predicate
+
+        fields = {'method': 'GET', 'bytes': '1960', 'sent': '-'}
+        assert_true(parse_predicate("method in PUT,GET")(fields))
+        assert_false(parse_predicate("method not in PUT,GET")(fields))
+        assert_true(parse_predicate("bytes numeric")(fields))
+        assert_false(parse_predicate("sent numeric")(fields))
+        assert_true(parse_predicate("method != PUT")(fields))
+        assert_true(parse_predicate("bytes ~ 19")(fields))
+        assert_false(parse_predicate("missing = GET")(fields))
+
+    @staticmethod
+    def test_required_literals():
+        """
+            Test extraction of literals required by a regex.
+        """
+        from pretaweb.collectd.groupingtail.prefilter import required_literals
+
+        regex = '^(?P<host>\\S+)\\s+(?P<method>PUT)\\s+\\/v1\\/AUTH_(?P<tenant>\\w+)(\\/\\S+|\\/|)\\s+(ab)*(cd)+'
+        assert_equal(sorted(required_literals(regex)), ['/v1/AUTH_', 'PUT', 'cd'])
+        assert_equal(required_literals('(?i)HEAD'), [])
+        assert_equal(required_literals('GET|PUT'), [])
+
+    @staticmethod
+    def test_prefilter():
+        """
+            Test that lines missing required literals are discarded and counted.
+        """
+        counter_inc = CounterInc('.* POST ')
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.prefilter.literals.append('nagios')
+        grouping_tail.add_match('posts', 'counter', counter_inc)
+        grouping_tail.update()
+
+        assert_equal(counter_inc.data, {})
+        assert_equal(dict(grouping_tail.prefilter_stats()), {'GroupBy': 0, 'posts': 10})
+        # Dispatched along the lag
+        grouping_tail.source.report_lag = True
+        metrics = dict((name, value) for name, valuetype, value in grouping_tail.read_metrics())
+        assert_equal((metrics['prefiltered_GroupBy'], metrics['prefiltered_posts']), (0, 10))
+
+    @staticmethod
+    def test_combined_match_engine():
+        """
+            Test that combined regexes give the same results as separate ones.
+        """
+        results = []
+        for engine in ("separate", "combined"):
+            counter_inc = CounterInc('.* GET ')
+            counter_sum = CounterSum('^\\S+ \\[\\S+ \"[^\"]*\" \"[^\"]*\"[^]]*] \\S+ \\S+ .+ HTTP\\S+ [0-9]+ ([0-9]+) ',
+                                     value_cast=int_cast)
+            named_sum = CounterSum('.* (?P<code>[0-9]+) (?P<size>[0-9]+) ', groupname="size", value_cast=int_cast)
+            posts = CounterInc('.* POST ')
+            grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+            grouping_tail.match_engine = engine
+            grouping_tail.add_match('gets', 'counter', counter_inc)
+            grouping_tail.add_match('tx', 'counter', counter_sum)
+            grouping_tail.add_match('size', 'counter', named_sum)
+            grouping_tail.add_match('posts', 'counter', posts)
+            assert_equal(grouping_tail.combined is not None, engine == "combined")
+            grouping_tail.update()
+            results.append([counter_inc.data, counter_sum.data, named_sum.data, posts.data])
+
+        assert_equal(results[0], [{'domain_com': 10}, {'domain_com': 19600}, {'domain_com': 19600}, {}])
+        assert_equal(results[0], results[1])
+
+    @staticmethod
+    def test_rewrite_groups():
+        """
+            Test that only used groups are kept capturing in combined regexes.
+        """
+        from pretaweb.collectd.groupingtail.multimatch import rewrite_groups
+
+        pattern = '^(\\S+) [(](?P<a>\\d+)\\((?P<b>x)(?:y)'
+        assert_equal(rewrite_groups(pattern, ['b'], 'p_'), '^(?:\\S+) [(](?:\\d+)\\((?P<p_b>x)(?:y)')
+        assert_equal(rewrite_groups(pattern, [None], 'p_'), '^(?P<p_>\\S+) [(](?:\\d+)\\((?:x)(?:y)')
+
+    @staticmethod
+    def test_shared_patterns():
+        """
+            Test that identical regexes are compiled and run once per line.
+        """
+        regex = '^\\S+ \\[\\S+ \"[^\"]*\" \"[^\"]*\"[^]]*] \\S+ \\S+ .+ HTTP\\S+ [0-9]+ ([0-9]+) '
+        counter_inc = CounterInc(regex)
+        counter_sum = CounterSum(regex, value_cast=int_cast)
+        assert_true(counter_inc.test is counter_sum.test)
+
+        hits = counter_inc.test.hits
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        grouping_tail.add_match('tx', 'counter', counter_sum)
+        grouping_tail.update()
+
+        assert_equal(counter_inc.data, {'domain_com': 10})
+        assert_equal(counter_sum.data, {'domain_com': 19600})
+        assert_equal(counter_inc.test.hits - hits, 10)
+
+    @staticmethod
+    def test_update_budget():
+        """
+            Test that an exhausted time budget leaves lines for the next update.
+        """
+        counter_inc = CounterInc('.')
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+
+        with patch('pretaweb.collectd.groupingtail.groupingtail.BATCH_LINES', 4):
+            assert_false(grouping_tail.source.update(budget=0))
+            assert_equal(counter_inc.data['domain_com'], 4)
+            assert_true(grouping_tail.source.update())
+        assert_equal(counter_inc.data['domain_com'], 10)
+
+    @staticmethod
+    def test_ingest_thread():
+        """
+            Test that a background thread processes new lines.
+        """
+        from pretaweb.collectd.groupingtail.workers import IngestThread
+
+        counter_inc = CounterInc('.')
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        ingest_thread = IngestThread([grouping_tail.source], poll_interval=0.01)
+        ingest_thread.start()
+        try:
+            for attempt in range(100):
+                with grouping_tail.source.lock:
+                    if counter_inc.data.get('domain_com') == 10:
+                        break
+                time.sleep(0.01)
+        finally:
+            ingest_thread.stop()
+            ingest_thread.join()
+        assert_equal(counter_inc.data.get('domain_com'), 10)
+
+    @staticmethod
+    def test_process_pool():
+        """
+            Test that files processed in worker processes send their metrics.
+        """
+        from pretaweb.collectd.groupingtail.workers import ProcessPool
+
+        counter_inc = CounterInc('.')
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        files = [dict(instance_name='my_stats', grouping_tail=grouping_tail)]
+
+        process_pool = ProcessPool(files, 2, poll_interval=0.01)
+        assert_equal(len(process_pool.processes), 1)
+        process_pool.start()
+        try:
+            received = []
+            for attempt in range(100):
+                received.extend(process_pool.read_metrics()[0])
+                if received:
+                    break
+                time.sleep(0.01)
+        finally:
+            process_pool.stop()
+        assert_equal(received, [('domain_com*requests', 'counter', 10)])
+        # Lines are processed in the worker, not here
+        assert_equal(counter_inc.data, {})
+
+    @staticmethod
+    def test_shards():
+        """
+            Test that lines parsed by several shards give the same results.
+        """
+        from pretaweb.collectd.groupingtail.instruments import GaugeThroughput
+
+        counter_inc = CounterInc('.')
+        counter_sum = CounterSum('^\\S+ \\[\\S+ \"[^\"]*\" \"[^\"]*\"[^]]*] \\S+ \\S+ .+ HTTP\\S+ [0-9]+ ([0-9]+) ',
+                                 value_cast=int_cast)
+        throughput = GaugeThroughput('.* (?P<bytes>[0-9]+) (?P<time>[0-9.]+)$', groupname="bytes", grouptime="time")
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        grouping_tail.add_match('tx', 'counter', counter_sum)
+        grouping_tail.add_match('bw', 'bytes', throughput)
+
+        source = grouping_tail.source
+        source.shard_count = 3
+        try:
+            with patch('pretaweb.collectd.groupingtail.groupingtail.BATCH_LINES', 2):
+                source.start_shards()
+                source.update()
+            metrics = dict((name, value) for name, value_type, value in grouping_tail.read_metrics())
+        finally:
+            source.shards.stop()
+
+        assert_equal(metrics['domain_com*requests'], 10)
+        assert_equal(metrics['domain_com*tx'], 19600)
+        assert_true(abs(metrics['domain_com*bw'] - 19600 / 3.047) < 1)
+
+    @staticmethod
+    def test_chunked_tail():
+        """
+            Test partial lines, truncation and checkpoints of the chunked tail.
+        """
+        from pretaweb.collectd.groupingtail.tailer import ChunkedTail
+
+        new_log = tempfile.NamedTemporaryFile(delete=False)
+        offset_file = new_log.name + ".offset"
+        tail = ChunkedTail(new_log.name, offset_file=offset_file, chunk_size=4)
+
+        new_log.write("first line\nsecond")
+        new_log.flush()
+        assert_equal(list(tail.readlines()), ["first line"])
+        new_log.write(" line\n")
+        new_log.flush()
+        assert_equal(list(tail.readlines()), ["second line"])
+        assert_equal(open(offset_file).read().split()[1], "23")
+
+        # A new tail resumes from the checkpoint
+        new_log.write("third line\n")
+        new_log.flush()
+        assert_equal(list(ChunkedTail(new_log.name, offset_file=offset_file).readlines()), ["third line"])
+
+        # Truncated in place
+        assert_equal(list(tail.readlines()), ["third line"])
+        new_log.truncate(0)
+        new_log.seek(0)
+        new_log.write("fourth\n")
+        new_log.flush()
+        assert_equal(list(tail.readlines()), ["fourth"])
+
+    @staticmethod
+    def test_checkpoint_resume():
+        """
+            Test that a source resumes where a previous one stopped.
+        """
+        from pretaweb.collectd.groupingtail.groupingtail import TailSource
+        from pretaweb.collectd.groupingtail.checkpoints import CheckpointStore
+
+        checkpoints = CheckpointStore(tempfile.mkdtemp())
+        new_log = tempfile.NamedTemporaryFile(delete=False)
+        # Without a checkpoint, reading starts from the end
+        source = TailSource(new_log.name, checkpoints=checkpoints)
+        new_log.write("1 first\n")
+        new_log.flush()
+        assert_equal(list(source.fin.readlines()), ["1 first"])
+        del source
+
+        # Written while stopped
+        new_log.write("2 second\n" * 3)
+        new_log.flush()
+        source = TailSource(new_log.name, checkpoints=checkpoints)
+        assert_equal(list(source.fin.readlines()), ["2 second"] * 3)
+
+        # Catch up at most 12 bytes, from the start of a line
+        new_log.write("3 third\n4 fourth\n")
+        new_log.flush()
+        source = TailSource(new_log.name, checkpoints=checkpoints, start="catchup", max_bytes=12)
+        assert_equal(list(source.fin.readlines()), ["4 fourth"])
+
+        # Skip to the end, ignoring the checkpoint
+        new_log.write("5 fifth\n")
+        new_log.flush()
+        source = TailSource(new_log.name, checkpoints=checkpoints, start="end")
+        assert_equal(list(source.fin.readlines()), [])
+
+    @staticmethod
+    def test_catch_up():
+        """
+            Test that a backlog is caught up in slices, reporting the lag.
+        """
+        counter_inc = CounterInc('.')
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        source = grouping_tail.source
+        source.report_lag = True
+        source.sample = 2
+        # Lag is known a chunk at a time
+        source.fin.chunk_size = 4096
+        new_log = open(source.filepath, "a")
+        for i in range(200):
+            copy_lines(BASIC_SMALL_LOG_FILE, new_log)
+
+        assert_false(source.update(max_lines=1000))
+        lag_bytes, lag_seconds = source.lag()
+        assert_true(lag_bytes > 0)
+        assert_true(source.behind_since is not None)
+        # Sampled while behind, every line again once caught up
+        assert_true(source.update())
+        assert_equal(source.lag(), (0, 0.0))
+        total = sum(counter_inc.data.values())
+        assert_equal(total + source.sampled_out, 2010)
+        assert_true(source.sampled_out > 0)
+        metric_names = [metric[0] for metric in grouping_tail.read_metrics()]
+        assert_true("lag_bytes" in metric_names and "sampled_out" in metric_names)
+
+    @staticmethod
+    def test_heavy_hitters():
+        """
+            Test that the most active groups are kept and the rest added up.
+        """
+        from pretaweb.collectd.groupingtail.heavyhitters import SpaceSaving
+        summary = SpaceSaving(2)
+        for key in "aaaabbc":
+            summary.touch(key)
+        # c replaced b, the least frequent, inheriting its count as error
+        assert_equal(sorted(summary.keys()), ["a", "c"])
+        assert_equal(summary.bounds("c"), (1, 3))
+        other = SpaceSaving(2)
+        for key in "bbbbd":
+            other.touch(key)
+        assert_equal(sorted(summary.merge(other)), ["c", "d"])
+        assert_equal(sorted(summary.keys()), ["a", "b"])
+
+        counter_sum = CounterSum('^(\d)')
+        counter_sum.set_groups_limit(2, "other")
+        for line in ["1", "1", "1", "2", "3", "4"]:
+            counter_sum.write(line, line)
+        assert_equal(dict(counter_sum.read()), {'1': 3.0, '4': 4.0, 'other': 5.0})
+
+    @staticmethod
+    def test_recent_groups():
+        """
+            Test that the groups last seen are kept for all instruments.
+        """
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(\\d)',
+                                     retention="recent", maxgroups=2)
+        counter_sum = CounterSum('^(\\d)')
+        grouping_tail.add_match('sum', 'counter', counter_sum)
+        # A cycle for each group
+        for line in ["1", "2", "3"]:
+            grouping_tail.process_line(line)
+            metrics = list(grouping_tail.read_metrics())
+        # 1, the least recently seen, is left out
+        assert_equal(sorted(metrics), [('2*sum', 'counter', 2.0), ('3*sum', 'counter', 3.0)])
+        assert_equal(sorted(counter_sum.data), ['2', '3'])
+        assert_equal(len(grouping_tail.recency), 2)
+
+    @staticmethod
+    def test_quantiles():
+        """
+            Test that quantiles are estimated within their relative accuracy.
+        """
+        from pretaweb.collectd.groupingtail.sketches import LogHistogram
+        from pretaweb.collectd.groupingtail.instruments import Quantiles
+        histogram = LogHistogram(0.01)
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+        assert_true(abs(histogram.quantile(0.99) - 0.99) <= 0.0099)
+        # Merging gives the histogram of all the values
+        other = LogHistogram(0.01)
+        for i in range(1, 1001):
+            other.add(i)
+        histogram.merge(other)
+        assert_equal(histogram.count, 2000)
+        assert_true(abs(histogram.quantile(0.75) - 500) <= 5)
+        assert_equal(LogHistogram().quantile(0.5), None)
+
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(\\w)')
+        quantiles = Quantiles('^\\w ([0-9.]+)', quantiles=(0.5, 0.999))
+        grouping_tail.add_match('time', 'response_time', quantiles)
+        for i in range(1, 101):
+            grouping_tail.process_line("a %s" % (i / 100.0))
+        metrics = dict((name, value) for name, valuetype, value in grouping_tail.read_metrics())
+        assert_equal(sorted(metrics), ['a*time_p50', 'a*time_p99_9'])
+        assert_true(abs(metrics['a*time_p50'] - 0.5) <= 0.005)
+        assert_true(abs(metrics['a*time_p99_9'] - 1.0) <= 0.01)
+        # Quantiles are of the values since the last read
+        assert_equal(list(grouping_tail.read_metrics()), [])
+
+    @staticmethod
+    def test_distinct_count():
+        """
+            Test that distinct values are counted within the expected error.
+        """
+        from pretaweb.collectd.groupingtail.sketches import HyperLogLog
+        from pretaweb.collectd.groupingtail.instruments import DistinctCount
+        counter = HyperLogLog()
+        for i in range(20000):
+            counter.add("10.0.%d.%d" % (i % 10000 / 256, i % 256))
+        assert_true(abs(counter.cardinality() - 10000) <= 500)
+        # Merging counts the values of both
+        other = HyperLogLog()
+        for i in range(5000, 15000):
+            other.add("10.0.%d.%d" % (i / 256, i % 256))
+        counter.merge(other)
+        assert_true(abs(counter.cardinality() - 15000) <= 750)
+        assert_equal(HyperLogLog().cardinality(), 0)
+
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(\\w)')
+        distinct_count = DistinctCount('^\\w (\\S+)')
+        grouping_tail.add_match('clients', 'gauge', distinct_count)
+        for i in range(30):
+            grouping_tail.process_line("a client%d" % (i % 3))
+            grouping_tail.process_line("b client%d" % i)
+        metrics = dict((name, value) for name, valuetype, value in grouping_tail.read_metrics())
+        assert_equal(metrics['a*clients'], 3)
+        # Two values may share a register
+        assert_true(29 <= metrics['b*clients'] <= 30)
+
+        # Lines without a value leave their group out
+        distinct_count = DistinctCount('^(?P<g>\\w)(?: (?P<v>\\S+))?$', groupname='v')
+        distinct_count.write("a", "a x")
+        distinct_count.write("b", "b")
+        assert_equal(distinct_count.read(), [("a", 1)])
+
+    @staticmethod
+    def test_top_keys():
+        """
+            Test that the most frequent sub-keys of each group are read.
+        """
+        from pretaweb.collectd.groupingtail.instruments import TopK
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(\\w)')
+        top_keys = TopK('^\\w (\\S+)', top=2, capacity=4)
+        grouping_tail.add_match('paths', 'gauge', top_keys)
+        for path, count in [("/index.html", 30), ("/a", 20), ("/b", 10)]:
+            for i in range(count):
+                grouping_tail.process_line("a %s" % path)
+        # A tail of sub-keys seen once, replacing each other
+        for i in range(5):
+            grouping_tail.process_line("a /tail%d" % i)
+        assert_equal(sorted(grouping_tail.read_metrics()),
+                     [('a*paths_a', 'gauge', 20), ('a*paths_index_html', 'gauge', 30)])
+        assert_equal(list(grouping_tail.read_metrics()), [])
+
+        # Names safe for collectd, however long the sub-key
+        from pretaweb.collectd.groupingtail.instruments import subkey_name
+        assert_equal(subkey_name("Mozilla/5.0 (X11; *)"), "Mozilla_5_0_X11")
+        long_name = subkey_name("/v1/AUTH_test/" + "c" * 100)
+        assert_equal(len(long_name), 48)
+        assert_true(long_name.startswith("v1_AUTH_test_ccc"))
+        assert_equal(len(subkey_name("/")), 8)
+        assert_true(long_name != subkey_name("/v1/AUTH_test/" + "c" * 101))
+
+        # Lines without a sub-key leave their group out
+        top_keys = TopK('^(?P<g>\\w)(?: (?P<k>\\S+))?$', groupname='k')
+        top_keys.write("a", "a x")
+        top_keys.write("b", "b")
+        assert_equal(top_keys.read(), [("a", {"x": 1})])
+
+    @staticmethod
+    def test_summary():
+        """
+            Test that several statistics are read from a single match.
+        """
+        from pretaweb.collectd.groupingtail.sketches import Moments
+        from pretaweb.collectd.groupingtail.instruments import Summary
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(\\w)')
+        summary = Summary('^\\w ([0-9]+)')
+        grouping_tail.add_match('bytes', 'groupingtail_summary', summary)
+        for value in [2, 4, 4, 4, 5, 5, 7, 9]:
+            grouping_tail.process_line("a %d" % value)
+        assert_equal(list(grouping_tail.read_metrics()),
+                     [('a*bytes', 'groupingtail_summary', (8, 40.0, 2.0, 9.0, 5.0, 2.0))])
+
+        # Merged summaries are those of all the values
+        first, second = Moments(), Moments()
+        for value in [2, 4, 4, 4]:
+            first.add(value)
+        for value in [5, 5, 7, 9]:
+            second.add(value)
+        first.merge(second)
+        assert_equal((first.count, first.minimum, first.maximum, first.mean, first.stddev()), (8, 2, 9, 5.0, 2.0))
+
+        summary = Summary('^\\w ([0-9]+)', statistics=("max", "count"))
+        summary.write("a", "a 3")
+        assert_equal(summary.read(), [("a", (3.0, 1))])
+
+    @staticmethod
+    def test_smoothed_rates():
+        """
+            Test that rates are smoothed over windows across reads.
+        """
+        from pretaweb.collectd.groupingtail.rates import SlidingWindow, Ewma
+        from pretaweb.collectd.groupingtail.instruments import WindowRate, EwmaRate
+        window = SlidingWindow(30)
+        for value in [100, 0, 0, 50]:
+            window.update(value, 10.0)
+        # The first cycle left the window
+        assert_equal(len(window.cycles), 3)
+        assert_equal(window.rate(), 50 / 30.0)
+        # Fractional values leave rounding residue once out of the window
+        window = SlidingWindow(20)
+        for value in [0.1, 0.7, 0.2, 0, 0, 0]:
+            window.update(value, 10.0)
+        assert_true(window.idle())
+        ewma = Ewma(60)
+        ewma.update(100, 10.0)
+        assert_equal(ewma.rate(), 10.0)
+        ewma.update(0, 10.0)
+        assert_true(0 < ewma.rate() < 10.0)
+
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(\\w)')
+        window_rate = WindowRate('.', windows=(20, 60), count_lines=True)
+        grouping_tail.add_match('requests', 'requests', window_rate)
+        with patch("time.time") as now:
+            for second, lines in [(10, 100), (20, 0), (30, 0), (40, 0), (50, 0), (60, 0), (70, 0)]:
+                for i in range(lines):
+                    grouping_tail.process_line("a")
+                now.return_value = window_rate.last_read + 10
+                metrics = dict((name, value) for name, valuetype, value in grouping_tail.read_metrics())
+                if second == 20:
+                    assert_equal(metrics, {'a*requests_20s': 5.0, 'a*requests_1m': 5.0})
+            # Idle over every window, no longer read
+            assert_equal(metrics, {})
+
+        # Groups with windows are bounded, keeping the most active ones
+        window_rate = EwmaRate('.', windows=(900,), count_lines=True)
+        window_rate.set_groups_limit(2)
+        for cycle in range(50):
+            window_rate.write("busy", "a")
+            window_rate.write("busy", "a")
+            window_rate.write("new%da" % cycle, "a")
+            window_rate.write("new%db" % cycle, "a")
+            groups = [groupname for groupname, value in window_rate.read()]
+        assert_true(len(window_rate.rates) <= 2)
+        assert_true(len(groups) <= 2 and "busy" in groups)
+
+    @staticmethod
+    def test_event_time():
+        """
+            Test that lines are measured in buckets of their own timestamp.
+        """
+        from pretaweb.collectd.groupingtail.eventtime import EventTime, TimestampParser
+        event_time = EventTime('ts', bucket_seconds=10, watermark=30)
+        grouping_tail = GroupingTail(tempfile.NamedTemporaryFile().name, '^(?P<ts>\\S+) (?P<tenant>\\w+)',
+                                     'tenant', event_time=event_time)
+        grouping_tail.add_match('requests', 'counter', CounterInc('.'))
+        # 1003 arrives late, but within the watermark
+        for line in ["1000 a", "1005 a", "1012 a", "1003 a", "1045 a"]:
+            grouping_tail.process_line(line)
+        assert_equal(list(grouping_tail.read_metrics()), [('a*requests', 'counter', 3, 1010)])
+        # Its bucket is closed already
+        grouping_tail.process_line("1001 a")
+        grouping_tail.process_line("1080 a")
+        grouping_tail.process_line("a")
+        assert_equal(list(grouping_tail.read_metrics()),
+                     [('a*requests', 'counter', 1, 1020), ('a*requests', 'counter', 1, 1050)])
+        assert_equal((event_time.late, event_time.untimed), (1, 0))
+        grouping_tail.process_line("now a")
+        assert_equal(event_time.untimed, 1)
+        # Timestamps in milliseconds are ahead of the clock and left out
+        grouping_tail.process_line("%d000 a" % time.time())
+        assert_equal((event_time.late, event_time.untimed), (1, 2))
+        grouping_tail.process_line("1081 a")
+        grouping_tail.process_line("1200 a")
+        assert_equal(list(grouping_tail.read_metrics()), [('a*requests', 'counter', 2, 1090)])
+
+        parse = TimestampParser("%d/%b/%Y:%H:%M:%S")
+        assert_equal(parse("18/Oct/2016:12:00:00"), time.mktime((2016, 10, 18, 12, 0, 0, 0, 0, -1)))
+        assert_equal(parse("18/Oct/2016"), None)
+
+    @staticmethod
+    def test_change_notifiers():
+        """
+            Test that both notifiers report a written file only once changed.
+        """
+        from pretaweb.collectd.groupingtail.notify import InotifyNotifier, PollingNotifier
+
+        class Source(object):
+            def __init__(self, filepath):
+                self.filepath = filepath
+
+        for notifier_class in (InotifyNotifier, PollingNotifier):
+            new_log = tempfile.NamedTemporaryFile(delete=False)
+            source = Source(new_log.name)
+            notifier = notifier_class()
+            notifier.watch(source)
+            # Reported once when watched, then only when written
+            assert_equal(notifier.poll(), set([source]))
+            assert_equal(notifier.poll(), set())
+            new_log.write("new line\n")
+            new_log.flush()
+            assert_equal(notifier.wait(1), set([source]))
+            assert_equal(notifier.poll(), set())
+            notifier.close()
+            os.remove(new_log.name)
+
     @staticmethod
     #@unittest.skip("demonstrating skipping")
     def test_multi_counter_inc():
@@ -434,6 +1138,140 @@ class TestFunction(TestGroupingTail):
         my_logger.removeHandler(handler)
 
 
+    @staticmethod
+    def test_syslog_buffer():
+        """
+            Test that the syslog buffer drops the oldest lines once full.
+        """
+        import socket
+        grouping_tail = GroupingTail('syslog://localhost:9514', "<159>-(.*)-")
+        source = grouping_tail.source
+        source.fin.capacity = 3
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(5):
+            sender.sendto("<159>-domain%d- 1\x00" % i, ("localhost", 9514))
+        sender.close()
+        # because its threads and sockets it needs a chance to catch up
+        time.sleep(0.1)
+
+        assert_equal(list(source.fin.readlines()), ["<159>-domain%d- 1" % i for i in (2, 3, 4)])
+        received, dropped, kernel_dropped = source.server.stats()
+        assert_equal((received, dropped), (5, 2))
+        assert_equal(kernel_dropped, 0)
+        grouping_tail.server.shutdown()
+
+    @staticmethod
+    def test_syslog_receive_sockets():
+        """
+            Test that datagrams shared out among reuseport sockets are all counted.
+        """
+        import socket
+        from pretaweb.collectd.groupingtail.groupingtail import TailSource
+        source = TailSource('syslog://localhost:9514', receive_sockets=3)
+        grouping_tail = GroupingTail(source.filepath, "<159>-(.*)-", source=source)
+        counter_inc = CounterInc('.')
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        source.start_shards()
+        # Give the receiver processes time to bind their sockets
+        time.sleep(0.2)
+
+        # Datagrams from several ports, so the kernel uses several sockets
+        for i in range(20):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto("<159>-domain- 1\x00", ("localhost", 9514))
+            sender.close()
+        time.sleep(0.1)
+        grouping_tail.update()
+        assert_equal(list(grouping_tail.read_metrics()), [('domain*requests', 'counter', 20)])
+        source.stop_shards()
+        source.server.shutdown()
+
+    @staticmethod
+    def test_event_loop():
+        """
+            Test that a single event loop serves both files and syslog sockets.
+        """
+        import socket
+        from pretaweb.collectd.groupingtail.groupingtail import TailSource
+        from pretaweb.collectd.groupingtail.eventloop import EventLoop
+        counter_inc = CounterInc('.')
+        grouping_tail = new_grouping_tail(BASIC_SMALL_LOG_FILE, group_by)
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        syslog_source = TailSource('syslog://localhost:9514', receive_thread=False)
+        syslog_tail = GroupingTail(syslog_source.filepath, "<159>-(.*)-", source=syslog_source)
+        syslog_counter = CounterInc('.')
+        syslog_tail.add_match('requests', 'counter', syslog_counter)
+
+        loop = EventLoop([grouping_tail.source, syslog_source], poll_interval=0.05)
+        loop.start()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(3):
+            sender.sendto("<159>-domain- 1\x00", ("localhost", 9514))
+        sender.close()
+        time.sleep(0.2)
+        loop.stop()
+        loop.join()
+
+        assert_equal(sum(counter_inc.data.values()), 10)
+        assert_equal(syslog_counter.data.get('domain'), 3)
+        syslog_source.server.shutdown()
+
+    @staticmethod
+    def test_spill_segment():
+        """
+            Test that lines over the buffer capacity are spilled and read back in order.
+        """
+        from pretaweb.collectd.groupingtail.receiver import QueueFile, SpillSegment
+        spill = SpillSegment(os.path.join(tempfile.mkdtemp(), "test.spill"), max_bytes=60)
+        queue = QueueFile(2, spill)
+        queue.extend(["line %d" % i for i in range(4)])
+        queue.extend(["line\n4"])
+        assert_equal(len(queue), 5)
+        assert_equal(spill.pending_bytes(), 30)
+        # Over max_bytes, the newest lines are dropped
+        queue.extend(["line %d" % i for i in range(5, 9)])
+        assert_equal(queue.dropped, 1)
+
+        assert_equal(list(queue.readlines()), ["line 0", "line 1", "line 2", "line 3"])
+        assert_equal(list(queue.readlines()), ["line\n4", "line 5"])
+        assert_equal(list(queue.readlines()), ["line 6", "line 7"])
+        assert_equal(spill.pending_bytes(), 0)
+        queue.extend(["line 9"])
+        assert_equal(list(queue.readlines()), ["line 9"])
+        queue.close()
+
+    @staticmethod
+    def test_syslog_tcp():
+        """
+            Test both syslog TCP framings and the backpressure of a full buffer.
+        """
+        import socket
+        from pretaweb.collectd.groupingtail.receiver import StreamConnection
+        assert_equal(StreamConnection.split("<1>a\n7 <2>b c\n<3>d\n11 <4>"),
+                     (["<1>a", "<2>b c\n", "<3>d"], "11 <4>"))
+        assert_equal(StreamConnection.split("<1>a\n12"), (["<1>a"], "12"))
+
+        grouping_tail = GroupingTail('syslog+tcp://localhost:9514', "<159>-(.*)-")
+        counter_inc = CounterInc('.')
+        grouping_tail.add_match('requests', 'counter', counter_inc)
+        source = grouping_tail.source
+        source.fin.capacity = 2
+        sender = socket.create_connection(("localhost", 9514))
+        sender.sendall("<159>-first- 1\n15 <159>-second- 2<159>-third- 3\n")
+        time.sleep(0.1)
+        # Full, the fourth message waits in the socket
+        sender.sendall("<159>-fourth- 4\n")
+        time.sleep(0.1)
+        assert_equal(len(source.fin), 3)
+        grouping_tail.update()
+        time.sleep(0.1)
+        sender.close()
+        time.sleep(0.1)
+        grouping_tail.update()
+        assert_equal(counter_inc.data, {'first': 1, 'second': 1, 'third': 1, 'fourth': 1})
+        assert_equal(source.server.stats(), (4, 0, None))
+        grouping_tail.server.shutdown()
+
     @staticmethod
     def test_namedgroups():
 